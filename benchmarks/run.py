@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+
+""" Benchmarks for ftldat.
+
+    Generates synthetic packs with synth.py and times a number of scenarios
+    on them.  The results are written as JSON, such that runs can be
+    compared to catch regressions:
+
+        python benchmarks/run.py --output results.json
+        python benchmarks/run.py --quick --only open,list """
+
+import subprocess
+import argparse
+import tempfile
+import platform
+import StringIO
+import os.path
+import shutil
+import random
+import json
+import time
+import sys
+import os
+
+import synth
+ftldat = synth.ftldat
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', 'src', 'main.py')
+
+class NullFile(object):
+    """ Sink that discards everything written to it. """
+    def write(self, s):
+        pass
+
+class Benchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='ftldat-bench-')
+        self.results = []
+        self.entries = args.entries
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+    def pack(self, name, **kwargs):
+        """ Generates the synthetic pack <name> once and returns a fresh
+            copy of it for a single run. """
+        template = self.path(name + '.template')
+        if not os.path.exists(template):
+            kwargs.setdefault('entries', self.entries)
+            kwargs.setdefault('seed', self.args.seed)
+            synth.generate(template, **kwargs)
+        path = self.path(name)
+        shutil.copyfile(template, path)
+        return path
+    def cli(self, *args):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call([sys.executable, MAIN] + list(args),
+                                  stdout=devnull)
+    def time(self, name, setup, run, **params):
+        """ Times <run>(<setup>()) a number of times.  Only <run> is
+            timed. """
+        if self.args.only and name not in self.args.only:
+            return
+        times = []
+        for i in xrange(self.args.repeat):
+            state = setup()
+            start = time.time()
+            run(state)
+            times.append(time.time() - start)
+        times.sort()
+        result = {'name': name,
+                  'params': params,
+                  'times': times,
+                  'min': times[0],
+                  'median': times[len(times) // 2]}
+        self.results.append(result)
+        print >> sys.stderr, '%-20s %8.4fs' % (name, result['min'])
+    #
+    # The scenarios
+    #
+    def bench_open(self):
+        path = self.pack('plain.dat')
+        self.time('open', lambda: path,
+                  lambda p: ftldat.FTLPack(p, readonly=True).close(),
+                  entries=self.entries)
+        self.time('open_compact', lambda: path,
+                  lambda p: ftldat.CompactFTLPack(p).close(),
+                  entries=self.entries)
+    def bench_list(self):
+        path = self.pack('plain.dat')
+        def run(p):
+            pack = ftldat.FTLPack(p, readonly=True, lazy=True)
+            for n, entry in pack.iter_entries():
+                pass
+            pack.close()
+        self.time('list', lambda: path, run, entries=self.entries)
+    def bench_extract_to(self):
+        path = self.pack('plain.dat')
+        def setup():
+            return ftldat.FTLPack(path, readonly=True)
+        def run(pack):
+            for filename in pack.list():
+                pack.extract_to(filename, NullFile())
+            pack.close()
+        self.time('extract_to', setup, run, entries=self.entries)
+    def bench_add(self):
+        count = max(1, self.entries // 10)
+        def setup():
+            return ftldat.FTLPack(self.pack('plain.dat'))
+        def run(pack):
+            for i in xrange(count):
+                pack.add('new/%s' % i, StringIO.StringIO('x' * 4096), 4096)
+            pack.close()
+        # The index of a synthetic pack is full, so this includes growing it
+        self.time('add', setup, run, entries=self.entries, added=count)
+    def bench_grow_index(self):
+        def setup():
+            return ftldat.FTLPack(self.pack('plain.dat'))
+        def run(pack):
+            pack._grow_index(self.entries)
+            pack.close()
+        self.time('grow_index', setup, run, entries=self.entries,
+                  amount=self.entries)
+    def bench_churn(self):
+        rng = random.Random(self.args.seed)
+        count = max(1, self.entries // 10)
+        def setup():
+            pack = ftldat.FTLPack(self.pack('plain.dat'))
+            return pack, rng.sample(sorted(pack.list()), count)
+        def run((pack, filenames)):
+            for filename in filenames:
+                pack.remove(filename)
+                size = rng.randint(0, 16384)
+                pack.add(filename, StringIO.StringIO('y' * size), size)
+            pack.close()
+        self.time('churn', setup, run, entries=self.entries, replaced=count)
+    def bench_repack(self):
+        def setup():
+            return ftldat.FTLPack(self.pack('fragmented.dat', churn=0.3))
+        def run(pack):
+            pack.repack()
+            pack.close()
+        self.time('repack', setup, run, entries=self.entries, churn=0.3)
+    def bench_commands(self):
+        path = self.pack('plain.dat')
+        unpacked = self.path('unpacked')
+        self.time('cmd_unpack', lambda: shutil.rmtree(unpacked, True),
+                  lambda state: self.cli('unpack', path, unpacked),
+                  entries=self.entries)
+        if not os.path.exists(unpacked):
+            self.cli('unpack', path, unpacked)
+        packed = self.path('packed.dat')
+        self.time('cmd_pack', lambda: None,
+                  lambda state: self.cli('pack', '-f', packed, unpacked),
+                  entries=self.entries)
+        self.time('cmd_hashes', lambda: None,
+                  lambda state: self.cli('hashes', '--no-cache', path),
+                  entries=self.entries)
+    def run(self):
+        try:
+            for name in sorted(dir(self)):
+                if name.startswith('bench_'):
+                    getattr(self, name)()
+        finally:
+            shutil.rmtree(self.tmp, True)
+        return {'python': platform.python_version(),
+                'platform': platform.platform(),
+                'entries': self.entries,
+                'seed': self.args.seed,
+                'results': self.results}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks ftldat')
+    parser.add_argument('--entries', '-n', type=int, default=20000,
+            help='Number of entries of the synthetic packs')
+    parser.add_argument('--repeat', '-r', type=int, default=3,
+            help='Number of runs per scenario')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Random seed for the synthetic packs')
+    parser.add_argument('--quick', '-q', action='store_true',
+            help='Use small packs and a single run')
+    parser.add_argument('--only', default=None,
+            help='Comma separated scenarios to run')
+    parser.add_argument('--output', '-o', default=None,
+            help='File to write the JSON results to.  Defaults to stdout')
+    args = parser.parse_args()
+    if args.quick:
+        args.entries = min(args.entries, 1000)
+        args.repeat = 1
+    if args.only:
+        args.only = set(args.only.split(','))
+    results = Benchmark(args).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print
+
+if __name__ == '__main__':
+    main()
+
+# vim: et:sw=4:ts=4:bs=2
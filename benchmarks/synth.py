@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+""" Deterministic generator of synthetic FTL .dat files for benchmarks.
+
+    Run as a script to create a single pack:
+
+        python benchmarks/synth.py out.dat --entries 10000 --churn 0.2 """
+
+import argparse
+import random
+import math
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+import main as ftldat
+
+class RandomFile(object):
+    """ File-like object that yields <size> pseudo random bytes. """
+    def __init__(self, rng, size):
+        self.rng = rng
+        self.todo = size
+    def read(self, n):
+        n = min(n, self.todo)
+        self.todo -= n
+        # Repeating a short random block is much faster than generating all
+        # bytes and is good enough for benchmarking I/O.
+        block = ''.join(chr(self.rng.randint(0, 255)) for i in xrange(64))
+        return (block * (n // 64 + 1))[:n]
+
+def entry_sizes(rng, count, distribution='lognormal', mean_size=8192):
+    """ Returns <count> entry sizes drawn from <distribution>, which is
+        one of lognormal, uniform or fixed. """
+    if distribution == 'fixed':
+        return [mean_size] * count
+    if distribution == 'uniform':
+        return [rng.randint(0, 2 * mean_size) for i in xrange(count)]
+    if distribution == 'lognormal':
+        # Most game data files are small with a long tail of large ones.
+        # This lognormal has roughly <mean_size> as mean.
+        mu = max(0.0, math.log(mean_size) - 0.5)
+        return [min(int(rng.lognormvariate(mu, 1.0)), 64 * mean_size)
+                    for i in xrange(count)]
+    raise ValueError("unknown distribution %s" % distribution)
+
+def entry_names(rng, count, name_length=24):
+    """ Returns <count> distinct filenames of about <name_length>
+        characters, spread over a few directory levels. """
+    names = []
+    for i in xrange(count):
+        folder = 'd%02d/s%02d' % (rng.randint(0, 15), rng.randint(0, 15))
+        stem = 'f%06d' % i
+        pad = max(0, name_length - len(folder) - len(stem) - 5)
+        names.append('%s/%s%s.xml' % (folder, stem, 'x' * rng.randint(0, pad)))
+    return names
+
+def generate(path, entries=1000, distribution='lognormal', mean_size=8192,
+                name_length=24, churn=0.0, seed=0):
+    """ Writes a synthetic pack to <path> and returns its list of
+        (filename, size).
+
+        After writing, a fraction <churn> of the entries is removed or
+        replaced by entries of a different size, which fragments the pack
+        like a pack that has been modded for a while. """
+    rng = random.Random(seed)
+    files = zip(entry_names(rng, entries, name_length),
+                entry_sizes(rng, entries, distribution, mean_size))
+    with open(path, 'wb') as f:
+        writer = ftldat.FTLPackWriter(f, files)
+        for filename, size in files:
+            writer.add(filename, RandomFile(rng, size), size)
+        writer.close()
+    if churn:
+        pack = ftldat.FTLPack(path)
+        sizes = dict(files)
+        for filename, size in rng.sample(files, int(churn * entries)):
+            if rng.random() < 0.5:
+                pack.remove(filename)
+                del sizes[filename]
+            else:
+                size = entry_sizes(rng, 1, distribution, mean_size)[0]
+                pack.replace(filename, RandomFile(rng, size), size)
+                sizes[filename] = size
+        pack.close()
+        files = sorted(sizes.iteritems())
+    return files
+
+def main():
+    parser = argparse.ArgumentParser(
+                description='Generates a synthetic FTL .dat')
+    parser.add_argument('datfile',
+            help='The datfile to create')
+    parser.add_argument('--entries', '-n', type=int, default=1000,
+            help='Number of entries')
+    parser.add_argument('--distribution', '-d', default='lognormal',
+            choices=('lognormal', 'uniform', 'fixed'),
+            help='Distribution of the entry sizes')
+    parser.add_argument('--mean-size', '-s', type=int, default=8192,
+            help='Mean entry size in bytes')
+    parser.add_argument('--name-length', '-l', type=int, default=24,
+            help='Typical filename length')
+    parser.add_argument('--churn', '-c', type=float, default=0.0,
+            help='Fraction of entries to remove or replace afterwards')
+    parser.add_argument('--seed', type=int, default=0,
+            help='Random seed')
+    args = parser.parse_args()
+    files = generate(args.datfile, args.entries, args.distribution,
+                     args.mean_size, args.name_length, args.churn, args.seed)
+    print '%s entries, %s bytes' % (len(files), os.path.getsize(args.datfile))
+
+if __name__ == '__main__':
+    main()
+
+# vim: et:sw=4:ts=4:bs=2
@@ -8,15 +8,35 @@
 #      GNU General Public License version 3.  See LICENSE.
 
 import collections
+import functools
+import array
+import contextlib
+import bisect
 import itertools
 import argparse
-import tempfile
+import BaseHTTPServer
+import SocketServer
+import mimetypes
+import urlparse
+import urllib
+import json
 import hashlib
 import os.path
+import posixpath
+import io
+import mmap
+import threading
 import struct
+import errno
+import zlib
+import shlex
+import time
 import sys
 import os
 
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+
 def ftl_path_split(path):
     """ Split a path in the way FTL expects them to be in .dat files.
         That is: the UNIX way. """
@@ -43,11 +63,169 @@ def nice_size(s):
     s /= 1024
     return str(s) + 'TiB'
 
+# At most this many bytes are read at once when scanning for entry
+# headers, if that covers more than one header
+HEADER_READAHEAD = 65536
+# Bytes read for a single entry header: its 8 bytes and, mostly, its
+# filename
+HEADER_SLACK = 256
+# Format of the index cache: a header followed by (n, size, len(filename))
+# for every entry and finally all the filenames
+INDEX_CACHE_MAGIC = 'FTLIDX1\0'
+INDEX_CACHE_HEADER = struct.Struct('<8sQdLL') # magic, size, mtime, crc, count
+# Amount of bytes copied at once when copying file contents
+COPY_BUFFER_SIZE = 65536
+# Hash algorithms that can be used for the hashes of entries
+HASH_ALGORITHMS = tuple(algo for algo in ('md5', 'sha1', 'sha256', 'blake2b')
+                            if hasattr(hashlib, algo))
+
 class FTLDatError(Exception):
     pass
 
+class IOStats(object):
+    """ Counts the I/O done through instrumented files and the wall time
+        spent, per phase of an operation.  See io_phase(). """
+    COUNTERS = ('seeks', 'reads', 'bytes_read', 'writes', 'bytes_written',
+                'bytes_mapped')
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = collections.OrderedDict()
+        self.start = time.time()
+        self.accessed = collections.OrderedDict()   # filenames read, in order
+    def _phase_stats(self, name):
+        if name not in self.phases:
+            self.phases[name] = dict.fromkeys(self.COUNTERS + ('time',), 0)
+        return self.phases[name]
+    def _stack(self):
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []   # [ [phase, start time] ]
+        return self.local.stack
+    def count(self, counter, amount=1):
+        """ Adds <amount> to <counter> of the current phase. """
+        stack = self._stack()
+        with self.lock:
+            self._phase_stats(stack[-1][0] if stack else 'other')[
+                                            counter] += amount
+    def access(self, filename):
+        """ Records that the contents of the entry <filename> are read. """
+        if filename not in self.accessed:
+            with self.lock:
+                self.accessed.setdefault(filename, None)
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Attributes the I/O and time within the block to phase <name>.
+            Time spent in nested phases is only counted for those. """
+        stack = self._stack()
+        now = time.time()
+        if stack:
+            self._add_time(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._add_time(name, now - stack.pop()[1])
+            if stack:
+                stack[-1][1] = now
+    def _add_time(self, name, amount):
+        with self.lock:
+            self._phase_stats(name)['time'] += amount
+    def summary(self):
+        """ Returns the statistics as a dictionary. """
+        with self.lock:
+            return {'wall_time': time.time() - self.start,
+                    'phases': [dict(self.phases[name], phase=name)
+                                    for name in self.phases]}
+
+# The IOStats I/O is counted in, if any.  Set by ftldat --stats.
+io_stats = None
+
+def note_access(filename):
+    """ Records the read of entry <filename> in the access trace, if I/O is
+        being counted. """
+    if io_stats is not None:
+        io_stats.access(filename)
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+    def __exit__(self, *exc_info):
+        pass
+
+def io_phase(name):
+    """ Returns a context manager that attributes the I/O within it to the
+        phase <name>, if I/O is being counted. """
+    if io_stats is None:
+        return _NoPhase()
+    return io_stats.phase(name)
+
+class InstrumentedFile(object):
+    """ Wraps a file object and counts its seeks, reads and writes in
+        io_stats. """
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+    def read(self, size=-1):
+        buf = self.f.read(size)
+        self.stats.count('reads')
+        self.stats.count('bytes_read', len(buf))
+        return buf
+    def write(self, s):
+        self.stats.count('writes')
+        self.stats.count('bytes_written', len(s))
+        self.f.write(s)
+    def seek(self, offset, whence=0):
+        self.stats.count('seeks')
+        self.f.seek(offset, whence)
+    def __iter__(self):
+        for line in self.f:
+            self.stats.count('reads')
+            self.stats.count('bytes_read', len(line))
+            yield line
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc_info):
+        self.f.close()
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+def in_io_phase(name):
+    """ Decorator that runs the decorated function in io_phase(<name>). """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with io_phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument(f):
+    """ Returns <f>, wrapped to count its I/O if I/O is being counted. """
+    if io_stats is None or isinstance(f, InstrumentedFile):
+        return f
+    return InstrumentedFile(f, io_stats)
+
+def open_file(path, mode='rb'):
+    """ Opens <path> like open(), but counts its I/O if that is asked
+        for. """
+    return instrument(open(path, mode))
+
+def copy_data(fi, fo, size):
+    """ Copies <size> bytes read from <fi> to <fo>. """
+    todo = size
+    while todo:
+        buf = fi.read(min(todo, COPY_BUFFER_SIZE))
+        if not buf:
+            raise ValueError("f is too small")
+        fo.write(buf)
+        todo -= len(buf)
+
 ftldat_entry = collections.namedtuple('ftldat_entry',
                         ('filename', 'size', 'offset'))
+repack_result = collections.namedtuple('repack_result',
+                        ('bytes_moved', 'old_size', 'new_size',
+                         'bytes_reclaimed'))
 
 class BasePack(object):
     """ Base pack.  Can be implemented either by a folder (unpacked) or
@@ -93,6 +271,7 @@ class FolderPack(object):
         for filename in self.list():
             yield (filename, os.stat(os.path.join(self.root,
                                 *ftl_path_split(filename))).st_size)
+    @in_io_phase('data copy')
     def add(self, filename, f, size):
         path = os.path.join(self.root, *ftl_path_split(filename))
         if os.path.exists(path):
@@ -102,7 +281,7 @@ class FolderPack(object):
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
         # Create file
-        with open(path, 'wb') as fo:
+        with open_file(path, 'wb') as fo:
             todo = size
             while todo:
                 buf = f.read(min(todo, 4096))
@@ -110,11 +289,12 @@ class FolderPack(object):
                     raise ValueError("f is too small")
                 fo.write(buf)
                 todo -= len(buf)
+    @in_io_phase('data copy')
     def extract_to(self, filename, f):
         path = os.path.join(self.root, *ftl_path_split(filename))
         if not os.path.exists(path):
             raise KeyError
-        with open(path, 'rb') as fi:
+        with open_file(path, 'rb') as fi:
             while True:
                 buf = fi.read(4096)
                 if not buf:
@@ -132,50 +312,212 @@ class FolderPack(object):
     #
     # Extra interface functions
     #
+    def path(self, filename):
+        """ Returns the path of <filename> on the filesystem. """
+        return os.path.join(self.root, *ftl_path_split(filename))
+    def create_dirs(self, filenames):
+        """ Creates the parent directories of all <filenames> at once. """
+        dirpaths = set(os.path.dirname(self.path(filename))
+                            for filename in filenames)
+        for dirpath in sorted(dirpaths):
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
     def open(self, filename, mode='rb'):
         """ Returns a new fileobj for <filename>. """
         path = os.path.join(self.root, *ftl_path_split(filename))
         dirpath = os.path.dirname(path)
         if not os.path.exists(dirpath):
             os.makedirs(dirpath)
-        return open(path, mode)
+        return open_file(path, mode)
+
+class FreeExtents(object):
+    """ Keeps track of the unused regions ("holes") of a datfile, such that
+        new entries can be put in the best fitting hole. """
+    def __init__(self):
+        self.starts = {}    # { offset: size }
+        self.ends = {}      # { offset + size: offset }
+        self.by_size = []   # sorted [ (size, offset) ]
+    def __len__(self):
+        return len(self.starts)
+    def total(self):
+        """ Returns the total size of the holes. """
+        return sum(self.starts.itervalues())
+    def _insert(self, offset, size):
+        self.starts[offset] = size
+        self.ends[offset + size] = offset
+        bisect.insort(self.by_size, (size, offset))
+    def _delete(self, offset):
+        size = self.starts.pop(offset)
+        del self.ends[offset + size]
+        del self.by_size[bisect.bisect_left(self.by_size, (size, offset))]
+        return size
+    def release(self, offset, size):
+        """ Marks the <size> bytes at <offset> as unused.  Adjacent holes
+            are merged. """
+        if not size:
+            return
+        if offset + size in self.starts:
+            size += self._delete(offset + size)
+        if offset in self.ends:
+            prev = self.ends[offset]
+            size += self._delete(prev)
+            offset = prev
+        self._insert(offset, size)
+    def find(self, size):
+        """ Returns the offset of the smallest hole of at least <size>
+            bytes, or None if there is none. """
+        i = bisect.bisect_left(self.by_size, (size, -1))
+        if i == len(self.by_size):
+            return None
+        return self.by_size[i][1]
+    def allocate(self, size):
+        """ Takes <size> bytes from the smallest hole that is large enough
+            and returns their offset.  Returns None if no hole is large
+            enough. """
+        offset = self.find(size)
+        if offset is None:
+            return None
+        hole_size = self.starts[offset]
+        self._delete(offset)
+        if hole_size > size:
+            self._insert(offset + size, hole_size - size)
+        return offset
+    def reserve(self, offset, size):
+        """ Marks whatever is unused of the <size> bytes at <offset> as
+            used. """
+        end = offset + size
+        for start, hole_size in self.starts.items():
+            hole_end = start + hole_size
+            if hole_end <= offset or start >= end:
+                continue
+            self._delete(start)
+            if start < offset:
+                self._insert(start, offset - start)
+            if hole_end > end:
+                self._insert(end, hole_end - end)
+    def ending_at(self, offset):
+        """ Returns the start of the hole that ends at <offset>, if any. """
+        return self.ends.get(offset)
+    def size_at(self, offset):
+        """ Returns the size of the hole that starts at <offset>, if any,
+            and 0 otherwise. """
+        return self.starts.get(offset, 0)
+
+class EntryReader(io.RawIOBase):
+    """ Read-only, seekable file-like object on the contents of a single
+        entry of a FTLPack.  See FTLPack.open_entry(). """
+    def __init__(self, pack, entry):
+        io.RawIOBase.__init__(self)
+        self.pack = pack
+        self.entry = entry
+        self.pos = 0
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def tell(self):
+        return self.pos
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self.pos + offset
+        elif whence == 2:
+            pos = self.entry.size + offset
+        else:
+            raise ValueError("invalid whence %s" % whence)
+        if pos < 0:
+            raise ValueError("negative seek position %s" % pos)
+        self.pos = pos
+        return pos
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.entry.size - self.pos
+        size = max(0, min(size, self.entry.size - self.pos))
+        if not size:
+            return ''
+        buf = self.pack._pread(self.entry.offset + self.pos, size)
+        self.pos += len(buf)
+        return buf
+    def readinto(self, b):
+        buf = self.read(len(b))
+        b[:len(buf)] = buf
+        return len(buf)
 
 class FTLPack(object):
-    def __init__(self, filename_or_fileobj, create=False, index_size=2048):
+    def __init__(self, filename_or_fileobj, create=False, index_size=2048,
+                        readonly=False, index_headroom=0.5, index_cache=None,
+                        lazy=False):
         """ Opens or creates a FTL .dat by <filename_or_fileobj>
 
             If <create> is False, the default, we will assume that <f> already
             contains a FTL .dat and read its index.  <index_size> is ignored.
 
             If <create> is True, we will assume that <f> does not contain an
-            existing FTL .dat and create an index of size <index_size>. """
+            existing FTL .dat and create an index of size <index_size>.
+
+            If <readonly> is True, the .dat is memory mapped and its entries
+            can be accessed without copying using view().  The pack cannot
+            be changed.
+
+            When the index is full, it is grown by <index_headroom> times its
+            current size.
+
+            <index_cache> is the path of a sidecar file with the decoded
+            index.  If it is valid, the entry headers are not read.  If it
+            exists but is stale, it is rewritten.  See save_index_cache().
+
+            If <lazy> is True, only the index itself is read and the entry
+            headers are not.  Until load() is called, only iter_entries()
+            can be used. """
         # We actually set these properly in _create_index and _read_index.
         # This is just for documentation.
         self.index = []      # [ idx: offset ]
         self.index_free = [] # [ idx with self.index[idx] == 0 ]
         self.metadata = []   # [ idx: (filename, size, offset) ]
         self.filenames = {}  # { filename: idx }
+        self.loaded = False  # whether metadata and filenames are filled
         self.eof = 0         # size of the file; thus also the offset of the
                              # end of the file
+        self.free = FreeExtents() # unused regions between the index and eof
+        self.batching = False     # whether index writes are deferred
+        self.index_dirty = False  # whether the index in the file is stale
+        self.pending_releases = [] # [ (offset, size) ] to release on flush
+        self.readonly = readonly
+        self.index_headroom = index_headroom
+        self.map = None      # mmap of the file, if readonly
+        self.lock = threading.Lock() # serializes _pread without a map
+        self.index_cache = index_cache
 
         # Open the file
-        if isinstance(filename_or_fileobj, basestring):
-            if create:
-                self.f = open(filename_or_fileobj, 'wb+')
+        if readonly and create:
+            raise ValueError("cannot create a read-only pack")
+        self.own_file = isinstance(filename_or_fileobj, basestring)
+        if self.own_file:
+            if readonly:
+                self.f = open_file(filename_or_fileobj, 'rb')
+            elif create:
+                self.f = open_file(filename_or_fileobj, 'wb+')
             else:
-                self.f = open(filename_or_fileobj, 'rb+')
+                self.f = open_file(filename_or_fileobj, 'rb+')
         else:
-            self.f = filename_or_fileobj
+            self.f = instrument(filename_or_fileobj)
 
         # Read or create the index
-        if create:
-            self._create_index(index_size)
-        else:
-            self._read_index()
+        with io_phase('index load'):
+            if create:
+                self._create_index(index_size)
+            else:
+                self._read_index(lazy)
+        if readonly:
+            self.map = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
 
     #
     # Internal functions
     #
+    def _check_writable(self):
+        if self.readonly:
+            raise FTLDatError("The pack is opened read-only")
     def _create_index(self, index_size=2048):
         """ Creates a new index.
             WARNING. This will remove the old index, if any. """
@@ -185,95 +527,374 @@ class FTLPack(object):
         self.metadata = [None] * index_size
         self.filenames = {}
         self.eof = index_size * 4 + 4
+        self.free = FreeExtents()
+        self.loaded = True
         # Write to file
         self.f.seek(0, 0)
         self.f.write(struct.pack('<L', index_size))
         for n in xrange(index_size):
             self.f.write(struct.pack('<L', 0))
-    def _read_index(self):
-        """ Reads (or re-reads) the index from the file. """
-        # Read index size
+    def _read_index(self, lazy=False):
+        """ Reads (or re-reads) the index from the file.  If <lazy>, the
+            entry headers are only read by load(). """
+        # Read the index size and the whole index in one go
         self.f.seek(0, 0)
         index_size = struct.unpack('<L', self.f.read(4))[0]
+        table = self.f.read(index_size * 4)
+        if len(table) != index_size * 4:
+            raise FTLDatError("Index is truncated")
         # Prepare new state
-        self.index = [0] * index_size
+        self.index = list(struct.unpack('<%dL' % index_size, table))
         self.metadata = [None] * index_size
         self.filenames = {}
-        self.index_free = []
-        # Read the index
-        for n in xrange(index_size):
-            self.index[n] = struct.unpack('<L', self.f.read(4))[0]
-        # Read the metadata
-        for n, offset in enumerate(self.index):
-            if not offset:
-                self.index_free.append(n)
-                continue
-            self.f.seek(offset, 0)
-            size, lfn = struct.unpack('<LL', self.f.read(8))
-            filename = self.f.read(lfn)
-            self.metadata[n] = ftldat_entry(filename=filename,
-                                            size=size,
-                                            offset=offset + 8 + len(filename))
-            if filename in self.filenames:
-                raise FTLDatError("Filename %s occurs more than once" %
-                                    filename)
-            self.filenames[filename] = n
+        self.index_free = [n for n, offset in enumerate(self.index)
+                                if not offset]
         # Determine eof
         self.f.seek(0, 2)
         self.eof = self.f.tell()
-    def _move_to_eof(self, n):
-        """ Move the nth entry to the end of the file.  Used by _grow_index """
-        # What to do?
-        old_offset = self.index[n]
-        new_offset = self.eof
-        size = self.metadata[n].size + len(self.metadata[n].filename) + 8
-        self.eof += size
-        todo = size
-        # Do it
-        while todo:
-            self.f.seek(old_offset + size - todo, 0)
-            buf = self.f.read(min(4096, todo))
-            assert buf
-            self.f.seek(new_offset + size - todo, 0)
+        # Read the metadata, preferably from the index cache
+        self.loaded = False
+        if self.index_cache is not None and self._load_index_cache(table):
+            self.loaded = True
+            self._find_free_extents()
+        elif not lazy:
+            self.load()
+    def _index_cache_stamp(self):
+        """ Returns the (size, mtime, crc32 of the index) the index cache
+            is valid for. """
+        self.f.flush()
+        self.f.seek(0, 0)
+        table = self.f.read(len(self.index) * 4 + 4)
+        return (os.fstat(self.f.fileno()).st_size,
+                os.fstat(self.f.fileno()).st_mtime,
+                zlib.crc32(table) & 0xffffffff)
+    def _load_index_cache(self, table):
+        """ Fills the metadata from the index cache, if it is valid for
+            this file.  <table> is the index as read from the file.
+            Returns whether it was valid. """
+        try:
+            with open_file(self.index_cache, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return False
+        if len(data) < INDEX_CACHE_HEADER.size:
+            return False
+        magic, size, mtime, crc, count = INDEX_CACHE_HEADER.unpack_from(data)
+        st = os.fstat(self.f.fileno())
+        crc_table = zlib.crc32(struct.pack('<L', len(self.index)) + table)
+        if (magic != INDEX_CACHE_MAGIC or size != st.st_size or
+                mtime != st.st_mtime or crc != crc_table & 0xffffffff or
+                count != len(self.index) - len(self.index_free)):
+            return False
+        # The fixed size part of the records: (n, size, len(filename))
+        start = INDEX_CACHE_HEADER.size
+        end = start + count * 12
+        if len(data) < end:
+            return False
+        records = struct.unpack('<%dL' % (count * 3), data[start:end])
+        metadata = [None] * len(self.index)
+        filenames = {}
+        for i in xrange(0, count * 3, 3):
+            n, size, lfn = records[i:i+3]
+            filename = data[end:end + lfn]
+            end += lfn
+            if (n >= len(self.index) or not self.index[n] or metadata[n]
+                    or len(filename) != lfn or filename in filenames):
+                return False
+            metadata[n] = ftldat_entry(filename=filename,
+                                       size=size,
+                                       offset=self.index[n] + 8 + lfn)
+            filenames[filename] = n
+        self.metadata = metadata
+        self.filenames = filenames
+        return True
+    def _find_free_extents(self):
+        """ Derives the unused regions of the file from the index. """
+        self.free = FreeExtents()
+        extents = sorted((x.offset - len(x.filename) - 8,
+                          x.offset + x.size) for x in self.metadata if x)
+        end = len(self.index) * 4 + 4
+        for start, next_end in extents:
+            if start > end:
+                self.free.release(end, start - end)
+            end = max(end, next_end)
+        if self.eof > end:
+            self.free.release(end, self.eof - end)
+    def _read_headers(self, index):
+        """ Yields (n, offset, size, filename) for every used slot <n> of
+            <index>.  The entry headers are read in ascending offset order
+            and headers close to each other are fetched with a single read,
+            so that this boils down to a few sequential reads. """
+        slots = sorted((offset, n) for n, offset in enumerate(index)
+                            if offset)
+        slack = max(8, HEADER_SLACK)
+        buf = ''
+        buf_offset = 0
+        with io_phase('index load'):
+            for i, (offset, n) in enumerate(slots):
+                start = offset - buf_offset
+                if start < 0 or start + 8 > len(buf):
+                    # The header is not in the buffer.  Read a new window
+                    # that spans the headers that follow within the
+                    # read-ahead, but no further.
+                    end = offset + slack
+                    for next_offset, next_n in itertools.islice(slots, i + 1,
+                                                                None):
+                        if next_offset + slack > offset + HEADER_READAHEAD:
+                            break
+                        end = next_offset + slack
+                    if offset != buf_offset + len(buf):
+                        self.f.seek(offset, 0)
+                    buf = self.f.read(end - offset)
+                    buf_offset = offset
+                    start = 0
+                    if len(buf) < 8:
+                        raise FTLDatError("Header of entry %s is truncated"
+                                                % n)
+                size, lfn = struct.unpack_from('<LL', buf, start)
+                if start + 8 + lfn > len(buf):
+                    # The filename does not fit in the buffer: extend it
+                    buf = buf[start:] + self.f.read(8 + lfn
+                                                    - (len(buf) - start))
+                    buf_offset = offset
+                    start = 0
+                    if 8 + lfn > len(buf):
+                        raise FTLDatError("Header of entry %s is truncated"
+                                                % n)
+                yield (n, offset, size, buf[start + 8:start + 8 + lfn])
+    @in_io_phase('data copy')
+    def _copy_within(self, src, dst, size):
+        """ Copies <size> bytes at offset <src> to offset <dst>.  If the two
+            regions overlap, <dst> must be smaller than <src>. """
+        done = 0
+        while done < size:
+            self.f.seek(src + done, 0)
+            buf = self.f.read(min(COPY_BUFFER_SIZE, size - done))
+            if not buf:
+                raise FTLDatError("Unexpected end of file")
+            self.f.seek(dst + done, 0)
             self.f.write(buf)
-            todo -= len(buf)
-        # Update the index and state
-        self.f.seek(n*4 + 4, 0)
-        self.f.write(struct.pack('<L', new_offset))
-        self.index[n] = new_offset
-        self.metadata[n] = self.metadata[n]._replace(
-                    offset=new_offset + len(self.metadata[n].filename)+8)
+            done += len(buf)
+    def _allocate(self, size):
+        """ Returns the offset of <size> unused bytes: those at the start of
+            the best fitting hole or otherwise those at the end of the
+            file. """
+        offset = self.free.allocate(size)
+        if offset is None:
+            offset = self.eof
+            self.eof += size
+        return offset
+    def _release(self, offset, size):
+        """ Marks the <size> bytes at <offset> as unused.  Unused bytes at
+            the end of the file are truncated.  During a batch, the index in
+            the file might still refer to these bytes, so they are only
+            released by flush(). """
+        if self.batching:
+            self.pending_releases.append((offset, size))
+            return
+        self.free.release(offset, size)
+        self._trim()
+    def _extend(self, n, extra):
+        """ Tries to make room for <extra> more bytes directly after the
+            contents of the nth entry: either from the hole after it or by
+            growing the file if it is the last entry.  Returns whether that
+            worked. """
+        end = self.metadata[n].offset + self.metadata[n].size
+        if end == self.eof:
+            self.eof += extra
+        elif self.free.size_at(end) >= extra:
+            self.free.reserve(end, extra)
+        else:
+            return False
+        return True
+    def _move_to_eof(self, ns):
+        """ Moves the entries <ns>, in that order, to the end of the file.
+            Used by _grow_index """
+        for n in ns:
+            # What to do?
+            old_offset = self.index[n]
+            new_offset = self.eof
+            size = self.metadata[n].size + len(self.metadata[n].filename) + 8
+            self.eof += size
+            # Do it
+            self._copy_within(old_offset, new_offset, size)
+            # Update the index and state
+            self.index[n] = new_offset
+            self._write_slot(n)
+            self.metadata[n] = self.metadata[n]._replace(
+                        offset=new_offset + len(self.metadata[n].filename)+8)
+            self.free.release(old_offset, size)
+    @in_io_phase('index flush')
     def _grow_index(self, amount=1):
         """ Grows the index with at least <amount> entries.
-            This is done by moving the first file after the index to the
-            end of the file. """ 
-        while True:
-            # For how many new free entries is there space after the index and
-            # before the first file?
-            index_used = [n for n in xrange(len(self.index)) if self.index[n]]
-            if not index_used:
-                # There is no file after the index, we can grow with as much
-                # as we like.  Limit ourselves to amount.
-                free_room = amount
-            else:
-                n = min(index_used, key=lambda n: self.index[n])
-                free_room = (self.index[n] - len(self.index)*4-4) / 4
-            if free_room >= amount:
-                break
-            # If it is not enough, move the first file and check again
-            self._move_to_eof(n)
+
+            So that adding many files takes linear time, the index grows by
+            at least <index_headroom> times its current size.  The files
+            in the way of the grown index are moved to the end of the file in
+            a single pass. """
+        amount = max(amount, int(len(self.index) * self.index_headroom), 1)
+        new_end = (len(self.index) + amount) * 4 + 4
+        # Find the files in the way and the first file that is not
+        in_the_way = []
+        first_offset = None
+        for n, offset in enumerate(self.index):
+            if not offset:
+                continue
+            if offset < new_end:
+                in_the_way.append((offset, n))
+            elif first_offset is None or offset < first_offset:
+                first_offset = offset
+        # The grown index might end past the end of the file.  The files in
+        # the way must then be moved after it, not into it.
+        if self.eof < new_end:
+            self.free.release(self.eof, new_end - self.eof)
+            self.eof = new_end
+        # Move the files in the way in offset order, so that they are read
+        # and written sequentially.
+        in_the_way.sort()
+        self._move_to_eof([n for offset, n in in_the_way])
+        # Use all room before the first file that is left
+        if first_offset is None:
+            free_room = amount
+        else:
+            free_room = (first_offset - len(self.index)*4 - 4) // 4
+        assert free_room >= amount
+        self.free.reserve(len(self.index)*4 + 4, free_room*4)
+        self.eof = max(self.eof, (len(self.index) + free_room)*4 + 4)
         # Update state
         self.index_free.extend(xrange(len(self.index) + free_room - 1,
                                 len(self.index) - 1, -1))
-        for n in xrange(free_room):
-            self.index.append(0)
-            self.metadata.append(None)
+        self.index.extend([0] * free_room)
+        self.metadata.extend([None] * free_room)
         # And write to the file
+        if self.batching:
+            self.index_dirty = True
+            return
         self.f.seek(0, 0)
         self.f.write(struct.pack('<L', len(self.index)))
         self.f.seek((len(self.index) - free_room)*4+4, 0)
-        for n in xrange(free_room):
-            self.f.write(struct.pack('<L', 0))
+        self.f.write('\0' * (free_room * 4))
+    @in_io_phase('data copy')
+    def _pread(self, offset, size):
+        """ Reads <size> bytes at <offset>.  Unlike self.f.read, this is
+            safe to call from several threads at once. """
+        if self.map is not None:
+            return self.map[offset:offset + size]
+        with self.lock:
+            self.f.seek(offset, 0)
+            return self.f.read(size)
+    @in_io_phase('index flush')
+    def _write_slot(self, n):
+        """ Writes the nth slot of the index to the file.  During a batch,
+            this is deferred to flush(). """
+        if self.batching:
+            self.index_dirty = True
+            return
+        self.f.seek(n*4 + 4, 0)
+        self.f.write(struct.pack('<L', self.index[n]))
+    def _trim(self):
+        """ Truncates the unused bytes at the end of the file, if any. """
+        start = self.free.ending_at(self.eof)
+        if start is not None:
+            self.free.reserve(start, self.eof - start)
+            self.eof = start
+            self.f.truncate(self.eof)
+    def _repack_incrementally(self, max_bytes):
+        """ Implementation of repack() with <max_bytes>.
+
+            Each step either moves the last entry into the best fitting hole,
+            or closes a hole by sliding all entries after it down, which
+            also closes the holes after it.  Of the steps that fit in what
+            is left of the budget, the one that moves the fewest bytes per
+            byte reclaimed goes first.  If none fits, a single entry is slid
+            over the hole before it, so repeated runs still converge.  Each move copies the data before it
+            updates the index, so the pack is consistent after every
+            step. """
+        old_size = self.eof
+        bytes_moved = 0
+        self._trim()
+        entries = sorted((offset, n) for n, offset in enumerate(self.index)
+                                if offset)
+        def length(n):
+            return self.metadata[n].size + len(self.metadata[n].filename) + 8
+        def move(n, new_offset):
+            self._copy_within(self.index[n], new_offset, length(n))
+            self.index[n] = new_offset
+            self._write_slot(n)
+            self.metadata[n] = self.metadata[n]._replace(
+                        offset=new_offset + len(self.metadata[n].filename)+8)
+        while len(self.free) and entries:
+            budget = max_bytes - bytes_moved
+            best = None     # (bytes moved per byte reclaimed, step, hole, i)
+            # Moving the last entry into a hole truncates the file up to
+            # the entry or hole before it.
+            tail_offset, tail_n = entries[-1]
+            tail_length = length(tail_n)
+            fit = self.free.find(tail_length)
+            if fit is not None and tail_length <= budget:
+                new_eof = self.free.ending_at(tail_offset)
+                if new_eof is None:
+                    new_eof = tail_offset
+                if fit == new_eof:
+                    new_eof += tail_length
+                best = (float(tail_length) / (self.eof - new_eof),
+                        'tail', fit, None)
+            # Closing a hole moves all entries after it.  The further back
+            # the hole, the fewer bytes that are.
+            i = len(entries)
+            cost = reclaimed = 0
+            for hole, hole_size in sorted(self.free.starts.iteritems(),
+                                          reverse=True):
+                while i and entries[i - 1][0] > hole:
+                    i -= 1
+                    cost += length(entries[i][1])
+                reclaimed += hole_size
+                if cost > budget:
+                    break
+                if best is None or float(cost) / reclaimed < best[0]:
+                    best = (float(cost) / reclaimed, 'slide', hole, i)
+            if best is None:
+                # Nothing is reclaimed within the budget.  Instead, slide
+                # the smallest entry that fits over the hole before it,
+                # which moves the hole towards the end of the file.
+                for hole in self.free.starts:
+                    i = bisect.bisect_left(entries, (hole, -1))
+                    cost = length(entries[i][1])
+                    if cost <= budget and (best is None or cost < best[0]):
+                        best = (cost, 'shift', hole, i)
+            if best is None:
+                break
+            ratio, step, hole, i = best
+            if step == 'tail':
+                self.free.reserve(hole, tail_length)
+                move(tail_n, hole)
+                entries.pop()
+                bisect.insort(entries, (hole, tail_n))
+                self._release(tail_offset, tail_length)
+                bytes_moved += tail_length
+                continue
+            if step == 'shift':
+                hole_size = self.free.size_at(hole)
+                n = entries[i][1]
+                self.free.reserve(hole, hole_size)
+                move(n, hole)
+                entries[i] = (hole, n)
+                self._release(hole + length(n), hole_size)
+                bytes_moved += length(n)
+                continue
+            self.free.reserve(hole, self.eof - hole)
+            offset = hole
+            for j in xrange(i, len(entries)):
+                n = entries[j][1]
+                move(n, offset)
+                entries[j] = (offset, n)
+                offset += length(n)
+                bytes_moved += length(n)
+            self.eof = offset
+            self.f.truncate(self.eof)
+        return repack_result(old_size=old_size, new_size=self.eof,
+                             bytes_moved=bytes_moved,
+                             bytes_reclaimed=old_size - self.eof)
     #
     # Base interface functions
     #
@@ -282,7 +903,9 @@ class FTLPack(object):
     def list_sizes(self):
         for filename, n in self.filenames.iteritems():
             yield (filename, self.metadata[n].size)
+    @in_io_phase('data copy')
     def add(self, filename, f, size):
+        self._check_writable()
         if filename in self.filenames:
             raise ValueError("filename already in use")
         # Find an index and offset
@@ -290,8 +913,7 @@ class FTLPack(object):
             self._grow_index()
         assert self.index_free
         n = self.index_free.pop()
-        offset = self.eof
-        self.eof += size + 8 + len(filename)
+        offset = self._allocate(size + 8 + len(filename))
         # Update state
         self.index[n] = offset
         self.filenames[filename] = n
@@ -299,29 +921,24 @@ class FTLPack(object):
                                         size=size,
                                         offset=offset+8+len(filename))
         # Write metadata
-        self.f.seek(n*4 + 4, 0)
-        self.f.write(struct.pack('<L', offset))
+        self._write_slot(n)
         self.f.seek(offset, 0)
         self.f.write(struct.pack('<LL', size, len(filename)))
         self.f.write(filename)
         # Write the data
-        todo = size
-        while todo:
-            buf = f.read(min(todo, 4096))
-            if not buf:
-                raise ValueError("f is too small")
-            self.f.write(buf)
-            todo -= len(buf)
+        copy_data(f, self.f, size)
+    @in_io_phase('data copy')
     def extract_to(self, filename, f):
         """ Writes the contents of the file with <filename> to <f>. """
         # Find index and offset
-        if filename not in self.filenames:
-            raise KeyError
-        n = self.filenames[filename]
-        offset = self.metadata[n].offset
+        if self.map is not None:
+            f.write(self.view(filename))
+            return
+        entry = self.entry(filename)
+        note_access(filename)
         # And pump!
-        self.f.seek(self.metadata[n].offset, 0)
-        todo = self.metadata[n].size
+        self.f.seek(entry.offset, 0)
+        todo = entry.size
         while todo:
             buf = self.f.read(min(todo, 4096))
             assert buf
@@ -329,18 +946,22 @@ class FTLPack(object):
             todo -= len(buf)
     def remove(self, filename):
         """ Removes the file with <filename> from the pack. """
+        self._check_writable()
         # Find index
         if filename not in self.filenames:
             raise KeyError
         n = self.filenames[filename]
+        offset = self.index[n]
+        entry = self.metadata[n]
         # Update state
         self.index[n] = 0
         self.index_free.append(n)
         self.metadata[n] = None
         del self.filenames[filename]
         # Write to file
-        self.f.seek(n*4+4, 0)
-        self.f.write(struct.pack('<L', 0))
+        self._write_slot(n)
+        # Only now the entry is gone from the index, its space can be reused
+        self._release(offset, entry.size + len(entry.filename) + 8)
     def __contains__(self, filename):
         return filename in self.filenames
     #
@@ -350,15 +971,219 @@ class FTLPack(object):
         """ Returns a list of quadruples (idx, filename, size, offset) """
         return [(n, x.filename, x.size, x.offset)
                     for n, x in enumerate(self.metadata) if x]
-    def repack(self):
+    @in_io_phase('index load')
+    def load(self):
+        """ Reads the entry headers, if opening the pack lazily postponed
+            that. """
+        if self.loaded:
+            return
+        for n, offset, size, filename in self._read_headers(self.index):
+            self.metadata[n] = ftldat_entry(filename=filename,
+                                            size=size,
+                                            offset=offset + 8 + len(filename))
+            if filename in self.filenames:
+                raise FTLDatError("Filename %s occurs more than once" %
+                                    filename)
+            self.filenames[filename] = n
+        self.loaded = True
+        if self.index_cache is not None and os.path.exists(self.index_cache):
+            self.save_index_cache()
+        # Determine the holes
+        self._find_free_extents()
+    def iter_entries(self):
+        """ Returns an iterator over the pairs (idx, ftldat_entry) of all
+            files in offset order.
+
+            If the headers have not been loaded yet, they are read while
+            iterating, so the first entries are available right away and
+            the headers are not kept in memory. """
+        if self.loaded:
+            return iter(sorted(((n, x) for n, x in enumerate(self.metadata)
+                                    if x), key=lambda e: e[1].offset))
+        return ((n, ftldat_entry(filename=filename,
+                                 size=size,
+                                 offset=offset + 8 + len(filename)))
+                    for n, offset, size, filename
+                        in self._read_headers(self.index))
+    @in_io_phase('index flush')
+    def save_index_cache(self):
+        """ Writes the decoded index to the index cache, such that opening
+            the pack again does not require reading all entry headers. """
+        if self.index_cache is None:
+            raise ValueError("no index_cache given")
+        size, mtime, crc = self._index_cache_stamp()
+        entries = [(n, x) for n, x in enumerate(self.metadata) if x]
+        records = []
+        for n, x in entries:
+            records.extend((n, x.size, len(x.filename)))
+        tmp_path = self.index_cache + '.tmp'
+        with open_file(tmp_path, 'wb') as f:
+            f.write(INDEX_CACHE_HEADER.pack(INDEX_CACHE_MAGIC, size, mtime,
+                                            crc, len(entries)))
+            f.write(struct.pack('<%dL' % len(records), *records))
+            f.write(''.join(x.filename for n, x in entries))
+        if sys.platform == 'win32' and os.path.exists(self.index_cache):
+            os.unlink(self.index_cache)
+        os.rename(tmp_path, self.index_cache)
+    def close(self):
+        """ Flushes and closes the pack.  An existing index cache is brought
+            up to date. """
+        if not self.readonly:
+            self.flush()
+            if (self.index_cache is not None and
+                    os.path.exists(self.index_cache)):
+                self.save_index_cache()
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.own_file:
+            self.f.close()
+    @contextlib.contextmanager
+    def batch(self):
+        """ Context manager that defers all writes to the index until the
+            end of the block, where the whole index is written at once.
+
+            The index in the file keeps referring to the old entries until
+            then, so the space of removed or moved entries is only reused
+            by later batches. """
+        self._check_writable()
+        self.batching = True
+        try:
+            yield self
+        finally:
+            self.batching = False
+            self.flush()
+    @in_io_phase('index flush')
+    def flush(self):
+        """ Writes the index, if a batch left it stale, and flushes the
+            file. """
+        if self.index_dirty:
+            self.f.seek(0, 0)
+            self.f.write(struct.pack('<%dL' % (len(self.index) + 1),
+                                     len(self.index), *self.index))
+            self.index_dirty = False
+        for offset, size in self.pending_releases:
+            self._release(offset, size)
+        self.pending_releases = []
+        # The index might have grown over some of the released entries
+        self.free.reserve(0, len(self.index)*4 + 4)
+        self.f.flush()
+    def entry(self, filename):
+        """ Returns the ftldat_entry of the file with <filename>. """
+        return self.metadata[self.filenames[filename]]
+    @in_io_phase('data copy')
+    def replace(self, filename, f, size):
+        """ Replaces the contents of the file with <filename> by the first
+            <size> bytes read from <f>.
+
+            If the new contents fit in the place of the old ones, or in the
+            hole directly after them, they are written in place and only the
+            size in the header changes.  Otherwise the entry is moved. """
+        self._check_writable()
+        if filename not in self.filenames:
+            raise KeyError
+        n = self.filenames[filename]
+        entry = self.metadata[n]
+        if size <= entry.size or self._extend(n, size - entry.size):
+            # Write in place
+            self.f.seek(entry.offset, 0)
+            copy_data(f, self.f, size)
+            self.f.seek(self.index[n], 0)
+            self.f.write(struct.pack('<L', size))
+            self.metadata[n] = entry._replace(size=size)
+            if size < entry.size:
+                self._release(entry.offset + size, entry.size - size)
+            return
+        # Write the entry elsewhere and only then point the index to it
+        old_offset = self.index[n]
+        offset = self._allocate(size + 8 + len(filename))
+        self.f.seek(offset, 0)
+        self.f.write(struct.pack('<LL', size, len(filename)))
+        self.f.write(filename)
+        copy_data(f, self.f, size)
+        self.index[n] = offset
+        self._write_slot(n)
+        self.metadata[n] = ftldat_entry(filename=filename,
+                                        size=size,
+                                        offset=offset+8+len(filename))
+        self._release(old_offset, entry.size + len(filename) + 8)
+    @in_io_phase('data copy')
+    def append(self, filename, f, size):
+        """ Appends the first <size> bytes read from <f> to the file with
+            <filename>.
+
+            If there is room directly after the entry, only the new bytes
+            are written.  Otherwise the entry is first copied within the
+            pack to a place where there is room. """
+        self._check_writable()
+        if filename not in self.filenames:
+            raise KeyError
+        n = self.filenames[filename]
+        entry = self.metadata[n]
+        if self._extend(n, size):
+            self.f.seek(entry.offset + entry.size, 0)
+            copy_data(f, self.f, size)
+            self.f.seek(self.index[n], 0)
+            self.f.write(struct.pack('<L', entry.size + size))
+            self.metadata[n] = entry._replace(size=entry.size + size)
+            return
+        # Copy the entry to a place with enough room and only then point
+        # the index to it
+        old_offset = self.index[n]
+        old_length = entry.size + len(filename) + 8
+        offset = self._allocate(old_length + size)
+        self._copy_within(old_offset, offset, old_length)
+        self.f.seek(offset + old_length, 0)
+        copy_data(f, self.f, size)
+        self.f.seek(offset, 0)
+        self.f.write(struct.pack('<L', entry.size + size))
+        self.index[n] = offset
+        self._write_slot(n)
+        self.metadata[n] = ftldat_entry(filename=filename,
+                                        size=entry.size + size,
+                                        offset=offset+8+len(filename))
+        self._release(old_offset, old_length)
+    def open_entry(self, filename):
+        """ Returns a new read-only, seekable file-like object on the
+            contents of the file with <filename>.
+
+            The object keeps its own position and reads at explicit offsets,
+            so many of them can be used concurrently on one pack, from
+            different threads.  They must not be used while the pack
+            changes. """
+        entry = self.entry(filename)
+        note_access(filename)
+        return EntryReader(self, entry)
+    @in_io_phase('data copy')
+    def view(self, filename):
+        """ Returns a read-only buffer on the contents of the file with
+            <filename>.  The contents are not copied.  Only available if the
+            pack is opened with <readonly>. """
+        if self.map is None:
+            raise FTLDatError("Views are only available on read-only packs")
+        entry = self.entry(filename)
+        if entry.offset + entry.size > len(self.map):
+            raise FTLDatError("Entry %s is truncated" % filename)
+        if io_stats is not None:
+            io_stats.count('bytes_mapped', entry.size)
+            io_stats.access(filename)
+        return buffer(self.map, entry.offset, entry.size)
+    @in_io_phase('repack')
+    def repack(self, max_bytes=None):
         """ Repacks the datfile.  This will remove overhead, which could
-            be created when adding, removing or replacing files. """
+            be created when adding, removing or replacing files.
+
+            If <max_bytes> is given, at most that many bytes are moved and
+            the moves that reclaim space right away go first.  This can
+            be repeated to compact the datfile bit by bit. """
+        self._check_writable()
+        self.flush()
+        if max_bytes is not None:
+            return self._repack_incrementally(max_bytes)
         # Create the new index
         entry = collections.namedtuple('repack_entry',
                             ('old_n', 'old_offset', 'filename', 'size',
                                     'new_offset'))
-        result = collections.namedtuple('result',
-                            ('bytes_moved', 'old_size', 'new_size'))
         bytes_moved = 0
         old_size = self.eof
         entries = [entry(old_n=n,
@@ -404,15 +1229,9 @@ class FTLPack(object):
             if entry.new_offset == entry.old_offset:
                 continue
             size = entry.size + 8 + len(entry.filename)
-            todo = size
-            bytes_moved += todo
+            bytes_moved += size
             assert entry.new_offset < entry.old_offset
-            while todo:
-                self.f.seek(entry.old_offset + size - todo, 0)
-                buf = self.f.read(min(4096, todo))
-                self.f.seek(entry.new_offset + size - todo, 0)
-                self.f.write(buf)
-                todo -= len(buf)
+            self._copy_within(entry.old_offset, entry.new_offset, size)
         # Truncate the ftldat!
         self.f.truncate(new_total_size)
         # Update state
@@ -427,31 +1246,775 @@ class FTLPack(object):
         for n, entry in enumerate(entries):
             self.filenames[entry.filename] = n
         self.index_free = []
-        return result(old_size=old_size, new_size=new_total_size,
-                        bytes_moved=bytes_moved)
+        self.free = FreeExtents()
+        return repack_result(old_size=old_size, new_size=new_total_size,
+                             bytes_moved=bytes_moved,
+                             bytes_reclaimed=old_size - new_total_size)
+
+def uint32_array(data=''):
+    """ Returns an array of unsigned 32-bit integers decoded from the
+        little endian string <data>. """
+    ret = array.array('I' if array.array('I').itemsize == 4 else 'L')
+    ret.fromstring(data)
+    if sys.byteorder == 'big':
+        ret.byteswap()
+    return ret
+
+class _SortedNames(object):
+    """ Helper class for CompactFTLPack: the filenames as a sequence sorted
+        by name, such that it can be searched with bisect. """
+    def __init__(self, pack):
+        self.pack = pack
+    def __len__(self):
+        return len(self.pack.by_name)
+    def __getitem__(self, i):
+        return self.pack._name(self.pack.by_name[i])
+
+class CompactFTLPack(FTLPack):
+    """ A read-only FTLPack that keeps its index in a few arrays instead of
+        lists, namedtuples and a dictionary, which takes far less memory
+        per entry for large packs.
+
+        The entries are numbered in offset order.  For the ith entry,
+        slots[i] is its index in the index, sizes[i] its size and
+        names[name_starts[i]:name_starts[i+1]] its filename.  by_name
+        contains the entry numbers sorted by filename for lookups. """
+    def __init__(self, filename_or_fileobj):
+        self.slots = uint32_array()
+        self.sizes = uint32_array()
+        self.name_starts = uint32_array()
+        self.names = ''
+        self.by_name = uint32_array()
+        super(CompactFTLPack, self).__init__(filename_or_fileobj,
+                                             readonly=True)
+    #
+    # Internal functions
+    #
+    def _read_index(self, lazy=False):
+        # Read the index size and the whole index in one go
+        self.f.seek(0, 0)
+        index_size = struct.unpack('<L', self.f.read(4))[0]
+        table = self.f.read(index_size * 4)
+        if len(table) != index_size * 4:
+            raise FTLDatError("Index is truncated")
+        self.index = uint32_array(table)
+        # Read the entry headers
+        self.slots = uint32_array()
+        self.sizes = uint32_array()
+        self.name_starts = uint32_array()
+        names = []
+        length = 0
+        for n, offset, size, filename in self._read_headers(self.index):
+            self.slots.append(n)
+            self.sizes.append(size)
+            self.name_starts.append(length)
+            names.append(filename)
+            length += len(filename)
+        self.name_starts.append(length)
+        self.by_name = uint32_array()
+        self.by_name.extend(sorted(xrange(len(names)),
+                                   key=names.__getitem__))
+        for i in xrange(len(self.by_name) - 1):
+            if names[self.by_name[i]] == names[self.by_name[i+1]]:
+                raise FTLDatError("Filename %s occurs more than once" %
+                                    names[self.by_name[i]])
+        self.names = ''.join(names)
+        self.loaded = True
+        # Determine eof
+        self.f.seek(0, 2)
+        self.eof = self.f.tell()
+    def _name(self, i):
+        return self.names[self.name_starts[i]:self.name_starts[i+1]]
+    def _find(self, filename):
+        """ Returns the number of the entry with <filename> or None. """
+        j = bisect.bisect_left(_SortedNames(self), filename)
+        if j < len(self.by_name) and self._name(self.by_name[j]) == filename:
+            return self.by_name[j]
+        return None
+    def _entry(self, i):
+        filename = self._name(i)
+        return ftldat_entry(filename=filename,
+                            size=self.sizes[i],
+                            offset=self.index[self.slots[i]] + 8 +
+                                        len(filename))
+    #
+    # Base interface functions
+    #
+    def list(self):
+        return (self._name(i) for i in xrange(len(self.slots)))
+    def list_sizes(self):
+        return ((self._name(i), self.sizes[i])
+                    for i in xrange(len(self.slots)))
+    def __contains__(self, filename):
+        return self._find(filename) is not None
+    #
+    # New interface functions
+    #
+    def list_metadata(self):
+        return [(n, x.filename, x.size, x.offset)
+                    for n, x in self.iter_entries()]
+    def entry(self, filename):
+        i = self._find(filename)
+        if i is None:
+            raise KeyError(filename)
+        return self._entry(i)
+    def iter_entries(self):
+        return ((self.slots[i], self._entry(i))
+                    for i in xrange(len(self.slots)))
+
+class AsyncFTLPack(object):
+    """ Runs the blocking I/O of a FTLPack on a pool of worker threads.
+
+        Every method but stream() returns at once with a multiprocessing
+        AsyncResult: pass a callback to be called with the value on a worker
+        thread, or call .get() to wait for it.  A caller that only uses
+        callbacks is never stuck behind the disk.  At most <workers>
+        operations run at a time; the rest queue up.
+
+        To read an entry chunk by chunk without blocking, get a reader with
+        open_entry() and call read_chunk() again from the callback of each
+        chunk, until the chunk is empty. """
+    def __init__(self, pack, workers=4, chunk_size=COPY_BUFFER_SIZE):
+        self.pack = pack
+        self.pool = ThreadPool(workers)
+        self.chunk_size = chunk_size
+    @classmethod
+    def open(cls, filename, workers=4, chunk_size=COPY_BUFFER_SIZE, **kwargs):
+        """ Returns an AsyncResult for an AsyncFTLPack on the pack in
+            <filename>, opened read-only with the FTLPack <kwargs>.  The
+            index is loaded on a worker thread. """
+        kwargs.setdefault('readonly', True)
+        result = cls(None, workers, chunk_size)
+        def load():
+            result.pack = FTLPack(filename, **kwargs)
+            return result
+        return result.pool.apply_async(load)
+    def _submit(self, func, *args, **kwargs):
+        callback = kwargs.pop('callback', None)
+        return self.pool.apply_async(func, args, kwargs, callback)
+    def list(self, callback=None):
+        """ Returns an AsyncResult for the list of filenames. """
+        return self._submit(lambda: list(self.pack.list()),
+                            callback=callback)
+    def list_sizes(self, callback=None):
+        """ Returns an AsyncResult for the list of (filename, size). """
+        return self._submit(lambda: list(self.pack.list_sizes()),
+                            callback=callback)
+    def read(self, filename, callback=None):
+        """ Returns an AsyncResult for the contents of <filename>. """
+        return self._submit(lambda: self.pack.open_entry(filename).read(),
+                            callback=callback)
+    def open_entry(self, filename, callback=None):
+        """ Returns an AsyncResult for an EntryReader on <filename>, to be
+            read with read_chunk(). """
+        return self._submit(self.pack.open_entry, filename,
+                            callback=callback)
+    def read_chunk(self, reader, size=None, callback=None):
+        """ Returns an AsyncResult for the next at most <size> bytes, which
+            defaults to the chunk size, of the EntryReader <reader>.  At the
+            end of the entry, the value is the empty string.  Only one read
+            of a reader should be pending at a time. """
+        return self._submit(reader.read, size or self.chunk_size,
+                            callback=callback)
+    def extract_to(self, filename, f, callback=None):
+        """ Returns an AsyncResult for writing the contents of <filename>
+            to <f>; its value is the number of bytes written. """
+        def extract():
+            reader = self.pack.open_entry(filename)
+            total = 0
+            while True:
+                buf = reader.read(self.chunk_size)
+                if not buf:
+                    return total
+                f.write(buf)
+                total += len(buf)
+        return self._submit(extract, callback=callback)
+    def stream(self, filename, chunk_size=None):
+        """ Iterates over the contents of <filename> in chunks of at most
+            <chunk_size> bytes.  This is only a read-ahead helper: it blocks
+            until each chunk is read, but the next chunk is read on a worker
+            thread while the caller handles the current one.  Use
+            read_chunk() to read without blocking. """
+        reader = self.pack.open_entry(filename)
+        pending = self.read_chunk(reader, chunk_size)
+        try:
+            while True:
+                buf = pending.get()
+                if not buf:
+                    return
+                pending = self.read_chunk(reader, chunk_size)
+                yield buf
+        finally:
+            # Do not leave a read behind if the caller stops early
+            pending.wait()
+    def close(self):
+        """ Waits for pending operations and closes the pack. """
+        self.pool.close()
+        self.pool.join()
+        if self.pack is not None:
+            self.pack.close()
+
+LAYOUTS = ('dir', 'size', 'trace')
+
+def read_trace(path):
+    """ Reads an access trace: a text file with one filename per line, in
+        the order they are read.  Empty lines and lines starting with # are
+        ignored.  ftldat --record-trace writes these. """
+    with open_file(path, 'rb') as f:
+        return [line.rstrip('\r\n') for line in f
+                    if line.strip() and not line.startswith('#')]
+
+def layout_files(files, layout, trace=None):
+    """ Returns the list of (filename, size) <files> in the order they
+        should be written to a pack for <layout>:
+
+          dir    files in the same folder together, folders sorted by name;
+          size   smallest files first;
+          trace  files in the order of the access trace <trace> (a list of
+                 filenames), then the files not in it as with dir. """
+    files = list(files)
+    by_dir = lambda x: (posixpath.dirname(x[0]).split('/'), x[0])
+    if layout == 'dir':
+        return sorted(files, key=by_dir)
+    if layout == 'size':
+        return sorted(files, key=lambda x: (x[1], x[0]))
+    if layout == 'trace':
+        rank = {}
+        for filename in trace:
+            rank.setdefault(filename, len(rank))
+        ret = sorted((x for x in files if x[0] in rank),
+                     key=lambda x: rank[x[0]])
+        ret.extend(sorted((x for x in files if x[0] not in rank),
+                          key=by_dir))
+        return ret
+    raise ValueError("unknown layout %s" % layout)
+
+class FTLPackWriter(object):
+    """ Writes a FTL .dat in a single sequential pass.
+
+        The layout of the whole .dat is computed up front from the list of
+        (filename, size) pairs, so the output file never has to seek and can
+        be a pipe or a socket. """
+    def __init__(self, f, files, index_size=None):
+        """ Writes the index for <files> to <f>.  The files must then be
+            added with add() in the same order.  The index will have
+            <index_size> entries, which defaults to the number of files. """
+        self.f = f
+        self.files = list(files)
+        self.n_written = 0
+        if index_size is None:
+            index_size = len(self.files)
+        if index_size < len(self.files):
+            raise ValueError("index_size is too small")
+        # Compute the layout
+        offsets = []
+        seen = set()
+        offset = 4 + index_size * 4
+        for filename, size in self.files:
+            if filename in seen:
+                raise FTLDatError("Filename %s occurs more than once" %
+                                    filename)
+            seen.add(filename)
+            offsets.append(offset)
+            offset += size + 8 + len(filename)
+        if offset > 0xffffffff:
+            raise FTLDatError("The datfile would be larger than 4 GiB")
+        self.size = offset
+        # Write the index
+        with io_phase('index flush'):
+            self.f.write(struct.pack('<L', index_size))
+            self.f.write(struct.pack('<%dL' % len(offsets), *offsets))
+            self.f.write('\0' * ((index_size - len(offsets)) * 4))
+    def _write_header(self, filename, size):
+        if self.n_written == len(self.files):
+            raise ValueError("all files have already been written")
+        if self.files[self.n_written] != (filename, size):
+            raise ValueError("expected %s of %s bytes" %
+                                self.files[self.n_written])
+        self.f.write(struct.pack('<LL', size, len(filename)))
+        self.f.write(filename)
+        self.n_written += 1
+    @in_io_phase('data copy')
+    def add(self, filename, f, size):
+        """ Writes the next file of the pack: the first <size> bytes read
+            from <f> as <filename>. """
+        self._write_header(filename, size)
+        copy_data(f, self.f, size)
+    @in_io_phase('data copy')
+    def add_buffer(self, filename, data):
+        """ Writes the next file of the pack: <data>, which can be a view
+            of another pack, as <filename>.  It is written at once. """
+        self._write_header(filename, len(data))
+        self.f.write(data)
+    def close(self):
+        """ Checks that all files have been written and flushes <f>. """
+        if self.n_written != len(self.files):
+            raise ValueError("only %s of %s files have been written" % (
+                                self.n_written, len(self.files)))
+        self.f.flush()
 
 class HashFile:
     """ Helper class.  Data written to this virtual file is hashed. """
-    def __init__(self):
-        self.h = hashlib.md5()
+    def __init__(self, algo='md5'):
+        self.h = hashlib.new(algo)
     def write(self, s):
         self.h.update(s)
     def finish_up(self):
         return self.h.hexdigest()
 
+class HashCache(object):
+    """ A sidecar file <datfile>.ftlhash that caches the hashes of the
+        entries of a datfile.
+
+        The hashes are keyed by (algo, filename, offset, size) of the entry.
+        The cache also records the size and mtime of the datfile when it was
+        saved.  If the datfile changed since without the cache being
+        updated, none of the hashes are trusted. """
+    def __init__(self, datfile):
+        self.datfile = datfile
+        self.path = datfile + '.ftlhash'
+        self.stamp = None   # (size, mtime) of the datfile when last saved
+        self.hashes = {}    # { (algo, filename, offset, size): hexdigest }
+        self.dirty = False
+        self._load()
+    def _datfile_stamp(self):
+        st = os.stat(self.datfile)
+        return (st.st_size, repr(st.st_mtime))
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open_file(self.path, 'rb') as f:
+            header = f.readline().split()
+            if header[:2] != ['ftlhash', '1'] or len(header) != 4:
+                # Unknown format: start afresh
+                return
+            self.stamp = (int(header[2]), header[3])
+            if self.stamp != self._datfile_stamp():
+                # Rewritten behind our back: an entry could have new
+                # contents at the same offset with the same size.
+                self.dirty = True
+                return
+            for line in f:
+                algo, offset, size, digest, filename = \
+                        line.rstrip('\n').split(' ', 4)
+                self.hashes[(algo, filename, int(offset), int(size))] = digest
+    def _key(self, pack, filename, algo):
+        entry = pack.entry(filename)
+        return (algo, filename, entry.offset, entry.size)
+    def lookup(self, pack, filenames, algo):
+        """ Returns a dictionary with the cached hashes of those of
+            <filenames> in <pack> that are known. """
+        ret = {}
+        for filename in filenames:
+            digest = self.hashes.get(self._key(pack, filename, algo))
+            if digest is not None:
+                ret[filename] = digest
+        return ret
+    def store(self, pack, hashes, algo):
+        """ Adds the dictionary <hashes> of <pack> to the cache. """
+        for filename, digest in hashes.iteritems():
+            self.hashes[self._key(pack, filename, algo)] = digest
+            self.dirty = True
+    def forget(self, filenames):
+        """ Removes all hashes of <filenames> from the cache. """
+        filenames = set(filenames)
+        for key in self.hashes.keys():
+            if key[1] in filenames:
+                del self.hashes[key]
+                self.dirty = True
+    def save(self, pack):
+        """ Atomically writes the cache, if it changed.  Hashes of entries
+            that are no longer in <pack> are dropped. """
+        stamp = self._datfile_stamp()
+        if not self.dirty and stamp == self.stamp:
+            return
+        for key in self.hashes.keys():
+            algo, filename, offset, size = key
+            if (filename not in pack or
+                    self._key(pack, filename, algo) != key):
+                del self.hashes[key]
+        tmp_path = self.path + '.tmp'
+        with open_file(tmp_path, 'wb') as f:
+            f.write('ftlhash 1 %s %s\n' % stamp)
+            for key, digest in sorted(self.hashes.iteritems()):
+                algo, filename, offset, size = key
+                f.write('%s %s %s %s %s\n' % (algo, offset, size, digest,
+                                                    filename))
+        if sys.platform == 'win32' and os.path.exists(self.path):
+            os.unlink(self.path)
+        os.rename(tmp_path, self.path)
+        self.stamp = stamp
+        self.dirty = False
+
+def hash_entry(pack, filename, algo='md5'):
+    """ Returns the hexdigest of the file with <filename> in <pack>.  Safe
+        to call from several threads on the same pack. """
+    hf = HashFile(algo)
+    if pack.map is not None:
+        hf.write(pack.view(filename))
+        return hf.finish_up()
+    # Without a map, extract_to would share the file position of the pack
+    reader = pack.open_entry(filename)
+    while True:
+        buf = reader.read(COPY_BUFFER_SIZE)
+        if not buf:
+            return hf.finish_up()
+        hf.write(buf)
+
+# The pack opened by a worker process of hash_entries
+_worker_pack = None
+
+def _init_hash_worker(datfile):
+    global _worker_pack
+    _worker_pack = FTLPack(datfile, readonly=True,
+                           index_cache=datfile + '.ftlidx')
+
+def _hash_entry_in_worker(args):
+    filename, algo = args
+    return hash_entry(_worker_pack, filename, algo)
+
+def hash_entries(pack, filenames, algo='md5', jobs=1, processes=False,
+                    cache=None):
+    """ Returns a dictionary with the hashes of <filenames> in <pack>.
+
+        If <jobs> is larger than one, the entries are hashed in parallel.
+        By default threads are used, which works well as hashlib releases
+        the GIL.  If <processes> is True, worker processes are used instead;
+        they re-open the pack, which must thus have been opened by filename.
+
+        If a HashCache <cache> is given, only the entries that are not in
+        the cache are hashed and their hashes are added to it. """
+    filenames = list(filenames)
+    if cache is not None:
+        ret = cache.lookup(pack, filenames, algo)
+        filenames = [filename for filename in filenames
+                        if filename not in ret]
+    else:
+        ret = {}
+    if jobs <= 1:
+        hashes = [hash_entry(pack, filename, algo) for filename in filenames]
+    elif processes:
+        pool = multiprocessing.Pool(jobs, _init_hash_worker,
+                                    (pack.f.name,))
+        try:
+            hashes = pool.map(_hash_entry_in_worker,
+                              [(filename, algo) for filename in filenames],
+                              chunksize=max(1, len(filenames) // (jobs * 4)))
+        finally:
+            pool.terminate()
+    else:
+        pool = ThreadPool(jobs)
+        try:
+            hashes = pool.map(lambda filename: hash_entry(pack, filename,
+                                                          algo), filenames)
+        finally:
+            pool.terminate()
+    hashes = dict(zip(filenames, hashes))
+    if cache is not None:
+        cache.store(pack, hashes, algo)
+    ret.update(hashes)
+    return ret
+
+class BlobStore(object):
+    """ A content-addressed store of files: the file with hex digest
+        <digest> is kept at <root>/<digest[:2]>/<digest[2:]>.  Unpacked
+        trees are made of hard links into the store, such that contents
+        shared between datfiles are stored only once. """
+    algo = 'sha1'
+    def __init__(self, root):
+        self.root = root
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+    def can_link_into(self, folder):
+        """ Returns whether files in the store can be hard linked into the
+            existing <folder>: whether they are on the same filesystem.  The
+            store is created if it does not exist. """
+        if not hasattr(os, 'link'):
+            return False
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        return os.stat(self.root).st_dev == os.stat(folder).st_dev
+    def put(self, pack, filename, digest):
+        """ Stores the file <filename> of <pack> with <digest>, unless the
+            store already has it.  Returns whether it was written. """
+        path = self.path(digest)
+        if os.path.exists(path):
+            return False
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError as e:
+                # Another worker might have created it meanwhile
+                if e.errno != errno.EEXIST:
+                    raise
+        tmp_path = '%s.%s-%s.tmp' % (path, os.getpid(),
+                                     threading.current_thread().ident)
+        with open_file(tmp_path, 'wb') as f:
+            pack.extract_to(filename, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # On Windows, another worker might have stored it meanwhile
+            if not os.path.exists(path):
+                raise
+            os.unlink(tmp_path)
+        return True
+    def link(self, digest, target):
+        """ Hard links <target> to the file with <digest>.  Returns False
+            if that is not possible, for instance because <target> is on
+            another filesystem. """
+        if not hasattr(os, 'link'):
+            return False
+        if os.path.exists(target):
+            os.unlink(target)
+        try:
+            os.link(self.path(digest), target)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            return False
+        return True
+
+def entries_equal(pack_a, pack_b, filename):
+    """ Returns whether the file <filename> has the same contents in <pack_a>
+        and <pack_b>.  The contents are compared chunk by chunk and the
+        comparison stops at the first difference. """
+    a = pack_a.open_entry(filename)
+    b = pack_b.open_entry(filename)
+    if a.entry.size != b.entry.size:
+        return False
+    while True:
+        buf_a = a.read(COPY_BUFFER_SIZE)
+        if buf_a != b.read(COPY_BUFFER_SIZE):
+            return False
+        if not buf_a:
+            return True
+
+def diff_packs(pack_a, pack_b, jobs=1, cache_a=None, cache_b=None):
+    """ Compares <pack_a> to <pack_b>.  Returns the sorted lists (added,
+        removed, changed) of the filenames only in <pack_b>, only in
+        <pack_a> and in both but with different contents.
+
+        Entries of different sizes differ.  Entries of equal size are
+        compared by a hash known to both HashCaches <cache_a> and <cache_b>
+        if possible and byte by byte otherwise, on <jobs> threads. """
+    sizes_a = dict(pack_a.list_sizes())
+    sizes_b = dict(pack_b.list_sizes())
+    added = sorted(set(sizes_b) - set(sizes_a))
+    removed = sorted(set(sizes_a) - set(sizes_b))
+    changed = []
+    todo = []
+    for filename in sorted(set(sizes_a) & set(sizes_b)):
+        if sizes_a[filename] != sizes_b[filename]:
+            changed.append(filename)
+        else:
+            todo.append(filename)
+    if cache_a is not None and cache_b is not None:
+        for algo in HASH_ALGORITHMS:
+            hashes_a = cache_a.lookup(pack_a, todo, algo)
+            hashes_b = cache_b.lookup(pack_b, todo, algo)
+            known = set(hashes_a) & set(hashes_b)
+            changed.extend(filename for filename in known
+                                if hashes_a[filename] != hashes_b[filename])
+            todo = [filename for filename in todo if filename not in known]
+    compare = lambda filename: entries_equal(pack_a, pack_b, filename)
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            equal = pool.map(compare, todo)
+        finally:
+            pool.terminate()
+    else:
+        equal = map(compare, todo)
+    changed.extend(filename for filename, eq in zip(todo, equal) if not eq)
+    return added, removed, sorted(changed)
+
+class PackServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves the entries of a datfile over HTTP at /<filename>.
+
+        The datfile is mapped read-only.  When it changes on disk, its index
+        is reloaded (from the index cache, if that is up to date) on the
+        next request. """
+    daemon_threads = True
+    def __init__(self, address, datfile):
+        self.datfile = datfile
+        self.lock = threading.Lock()
+        self.stamp = None   # (inode, size, mtime) of the loaded datfile
+        self.pack = None
+        self.hashes = None  # HashCache of the datfile, if it has one
+        self.get_pack()
+        BaseHTTPServer.HTTPServer.__init__(self, address, PackRequestHandler)
+    def get_pack(self):
+        """ Returns the pack, its hash cache and the (inode, size, mtime) of
+            the datfile, reloaded if the datfile
+            changed since they were last loaded.  Requests that still use
+            the previous pack keep their own mapping of it. """
+        with self.lock:
+            st = os.stat(self.datfile)
+            stamp = (st.st_ino, st.st_size, st.st_mtime)
+            if stamp != self.stamp:
+                self.pack = FTLPack(self.datfile, readonly=True,
+                                    index_cache=self.datfile + '.ftlidx')
+                self.hashes = None
+                if os.path.exists(self.datfile + '.ftlhash'):
+                    self.hashes = HashCache(self.datfile)
+                self.stamp = stamp
+            return self.pack, self.hashes, self.stamp
+
+class PackRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Handles GET and HEAD requests for PackServer.  Supports keep-alive,
+        single byte ranges and conditional requests on ETags. """
+    protocol_version = 'HTTP/1.1'
+    def do_GET(self):
+        self._serve(True)
+    def do_HEAD(self):
+        self._serve(False)
+    def _etag(self, pack, hashes, stamp, entry):
+        """ The cached md5 of <entry> if known.  Otherwise its offset and
+            size together with the <stamp> of the datfile: an entry can be
+            replaced in place with the same size, so any change of the
+            datfile changes the ETags of such entries. """
+        if hashes is not None:
+            digest = hashes.lookup(pack, [entry.filename], 'md5').get(
+                                                        entry.filename)
+            if digest is not None:
+                return '"%s"' % digest
+        ino, size, mtime = stamp
+        return '"%x-%x-%x-%x-%x"' % (entry.offset, entry.size, ino, size,
+                                     int(mtime * 1000000))
+    def _range(self, size):
+        """ Returns the (start, end) requested by the Range header, None if
+            the whole entry should be sent and False if the range cannot be
+            satisfied.  Multiple ranges are answered with the whole
+            entry. """
+        header = self.headers.getheader('Range')
+        if not header or not header.startswith('bytes='):
+            return None
+        spec = header[len('bytes='):].strip()
+        if ',' in spec:
+            return None
+        first, sep, last = spec.partition('-')
+        try:
+            if not first:
+                suffix = int(last)
+                if not suffix:
+                    return False
+                start, end = max(0, size - suffix), size
+            else:
+                start = int(first)
+                end = min(int(last) + 1, size) if last else size
+                if last and int(last) < start:
+                    return None
+        except ValueError:
+            return None
+        if start >= size:
+            return False
+        return start, end
+    def _serve(self, send_body):
+        filename = urllib.unquote(urlparse.urlsplit(self.path).path)
+        filename = filename.lstrip('/')
+        try:
+            pack, hashes, stamp = self.server.get_pack()
+        except (FTLDatError, EnvironmentError) as e:
+            self.send_error(503, str(e))
+            return
+        if filename not in pack:
+            self.send_error(404)
+            return
+        entry = pack.entry(filename)
+        note_access(filename)
+        etag = self._etag(pack, hashes, stamp, entry)
+        if_none_match = self.headers.getheader('If-None-Match')
+        if if_none_match is not None and (if_none_match.strip() == '*' or
+                etag in [tag.strip() for tag in if_none_match.split(',')]):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        rng = self._range(entry.size)
+        if rng is False:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%s' % entry.size)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if rng is None:
+            start, end = 0, entry.size
+            self.send_response(200)
+        else:
+            start, end = rng
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%s/%s' % (
+                                    start, end - 1, entry.size))
+        self.send_header('Content-Type', mimetypes.guess_type(filename)[0]
+                                            or 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if send_body:
+            self._send_data(pack, entry, start, end - start)
+    def _send_data(self, pack, entry, start, length):
+        """ Sends <length> bytes of <entry> from <start> on, straight from
+            the mapping of the datfile. """
+        data = pack.view(entry.filename)
+        for pos in xrange(start, start + length, COPY_BUFFER_SIZE):
+            self.wfile.write(buffer(data, pos,
+                                min(COPY_BUFFER_SIZE, start + length - pos)))
+
 class Program(object):
+    def __init__(self):
+        self.packs = []
+        self.hash_cache = None  # HashCache of the datfile, if it is changed
+    def _open_pack(self, readonly=False, lazy=False, datfile=None):
+        """ Opens the datfile, or <datfile>, with its index cache.  It is
+            closed after the command has run.  If the datfile is opened to
+            be changed, its hash cache is loaded first, while it is still
+            up to date. """
+        if datfile is None:
+            datfile = self.args.datfile
+        if not readonly and os.path.exists(datfile + '.ftlhash'):
+            self.hash_cache = HashCache(datfile)
+        pack = FTLPack(datfile, readonly=readonly, lazy=lazy,
+                       index_cache=datfile + '.ftlidx')
+        self.packs.append(pack)
+        return pack
+    def _hash_entries(self, pack):
+        """ Hashes all entries of <pack> as specified by the hash arguments.
+            The hash cache is used if requested or if it already exists. """
+        cache = None
+        if self.args.cache or (not self.args.no_cache and
+                os.path.exists(self.args.datfile + '.ftlhash')):
+            cache = HashCache(self.args.datfile)
+        hashes = hash_entries(pack, pack.list(), self.args.algo,
+                              self.args.jobs, self.args.processes, cache)
+        if cache is not None:
+            cache.save(pack)
+        return hashes
+    def _forget_hashes(self, pack, filenames):
+        """ Drops <filenames> from the hash cache of the datfile, if there
+            is one, and saves it for the changed datfile.  Their new contents
+            might have been written at the same offset with the same size,
+            which the cache would not notice. """
+        if self.hash_cache is None:
+            return
+        self.hash_cache.forget(filenames)
+        # The cache records the size and mtime of the datfile as it is on
+        # disk, so all writes must have been done.
+        pack.flush()
+        self.hash_cache.save(pack)
+    def _drop_hash_cache(self, datfile):
+        """ Removes the hash cache of <datfile>, which has been replaced. """
+        if os.path.exists(datfile + '.ftlhash'):
+            os.unlink(datfile + '.ftlhash')
     def cmd_list(self):
-        pack = FTLPack(self.args.datfile)
-        for filename in pack.list():
-            print filename
+        pack = self._open_pack(readonly=True, lazy=True)
+        for n, entry in pack.iter_entries():
+            print entry.filename
     def cmd_hashes(self):
-        pack = FTLPack(self.args.datfile)
-        hashes = {}
-        # First generate hashes sequentially
-        for filename in pack.list():
-            hf = HashFile()
-            pack.extract_to(filename, hf)
-            hashes[filename] = hf.finish_up()
+        pack = self._open_pack(readonly=True)
+        # First generate hashes
+        hashes = self._hash_entries(pack)
         filenames = hashes.keys()
         # Then sort and display
         filenames.sort()
@@ -459,74 +2022,86 @@ class Program(object):
             print '%s %s' % (filename, hashes[filename])
     def cmd_info(self):
         print 'Loading index ...'
-        pack = FTLPack(self.args.datfile)
+        # Without hashes, the entries can be shown while they are read
+        pack = self._open_pack(readonly=True, lazy=not self.args.hashes)
+        if self.args.hashes:
+            hashes = self._hash_entries(pack)
         print 
         print "%-4s %-7s %-57s%10s" % ('#', 'offset', 'filename', 'size')
         N = 0
         c_size = 0
-        for i, filename, size, offset in pack.list_metadata():
+        for i, (filename, size, offset) in pack.iter_entries():
             print "%-4s %-7s %-57s%10s" % (i, hex(offset)[2:], filename,
                             str(size) if self.args.bytes else nice_size(size))
             if self.args.hashes:
-                hf = HashFile()
-                pack.extract_to(filename, hf)
-                print "        md5: %s" % hf.finish_up()
+                print "        %s: %s" % (self.args.algo, hashes[filename])
             c_size += size
             N += 1
         print
         print '  %s/%s entries' % (N, len(pack.index))
         print '  %s' % str(c_size) if self.args.bytes else nice_size(c_size)
     def cmd_pack(self):
-        if os.path.exists(self.args.datfile) and not self.args.force:
+        to_stdout = self.args.datfile == '-'
+        # Keep stdout clean if we write the datfile to it
+        log = sys.stderr if to_stdout else sys.stdout
+        if (not to_stdout and os.path.exists(self.args.datfile)
+                and not self.args.force):
             print ('ERROR %s already exists. Use -f to override.'
                     % self.args.datfile)
             return -2
         if self.args.folder is None:
+            if to_stdout:
+                print >> log, 'ERROR a folder is required to pack to stdout.'
+                return -11
             self.args.folder = self.args.datfile + '-unpacked'
-        print 'Listing files to pack ...'
+        print >> log, 'Listing files to pack ...'
         folder = FolderPack(self.args.folder)
         files = list(folder.list_sizes())
+        if self.args.layout:
+            files = layout_files(files, self.args.layout, self._trace())
         if self.args.indexsize is not None:
             indexSize = max(self.args.indexsize, len(files))
         else:
             indexSize = len(files)
-        print 'Create datfile ...'
-        pack = FTLPack(self.args.datfile, create=True, index_size=indexSize)
-        print 'Packing ...'
-        for _file, size in files:
-            print " %s" % _file
-            pack.add(_file, folder.open(_file), size)
+        print >> log, 'Create datfile ...'
+        if to_stdout:
+            if sys.platform == 'win32':
+                import msvcrt
+                msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+            f = instrument(sys.stdout)
+        else:
+            f = open_file(self.args.datfile, 'wb')
+        try:
+            writer = FTLPackWriter(f, files, index_size=indexSize)
+            print >> log, 'Packing ...'
+            for _file, size in files:
+                print >> log, " %s" % _file
+                with folder.open(_file) as fi:
+                    writer.add(_file, fi, size)
+            writer.close()
+        finally:
+            if not to_stdout:
+                f.close()
+        if not to_stdout:
+            self._drop_hash_cache(self.args.datfile)
     def cmd_append(self):
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack()
         if not os.path.exists(self.args.appendix):
             print 'ERROR %s does not exist.' % self.args.appendix
             return -8
-        f = None
-        try:
-            if not self.args.filename in pack:
-                if not self.args.force:
-                    print ('ERROR %s does not exist.  Use -f to add anyway'
-                            % self.args.filename)
-                    return -9
-                f = open(self.args.appendix, 'rb')
+        if not self.args.filename in pack and not self.args.force:
+            print ('ERROR %s does not exist.  Use -f to add anyway'
+                    % self.args.filename)
+            return -9
+        size = os.stat(self.args.appendix).st_size
+        with open_file(self.args.appendix, 'rb') as f:
+            if self.args.filename in pack:
+                pack.append(self.args.filename, f, size)
             else:
-                f = tempfile.TemporaryFile()
-                pack.extract_to(self.args.filename, f)
-                pack.remove(self.args.filename)
-                with open(self.args.appendix, 'rb') as fi:
-                    while True:
-                        buf = fi.read(4096)
-                        if not buf:
-                            break
-                        f.write(buf)
-                f.seek(0, 0)
-            size = os.fstat(f.fileno()).st_size
-            pack.add(self.args.filename, f, size)
-        finally:
-            if f:
-                f.close()
+                pack.add(self.args.filename, f, size)
+        self._forget_hashes(pack, [self.args.filename])
     def cmd_add(self):
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack()
         if not os.path.exists(self.args.file):
             print 'ERROR %s does not exist.' % self.args.file
             return -7
@@ -538,11 +2113,14 @@ class Program(object):
                 print ('ERROR %s already exists. Use -f to replace.'
                         % self.args.filename)
                 return -2
-            pack.remove(self.args.filename)
-        with open(self.args.file, 'rb') as f:
-            pack.add(self.args.filename, f, size)
+            with open_file(self.args.file, 'rb') as f:
+                pack.replace(self.args.filename, f, size)
+        else:
+            with open_file(self.args.file, 'rb') as f:
+                pack.add(self.args.filename, f, size)
+        self._forget_hashes(pack, [self.args.filename])
     def cmd_extract(self):
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack(readonly=True)
         if (self.args.target and os.path.exists(self.args.target) and
                 not self.args.force):
             print ('ERROR %s already exists.  Use -f to override.'
@@ -553,17 +2131,54 @@ class Program(object):
             return -5
         try:
             if self.args.target:
-                f = open(self.args.target, 'wb')
+                f = open_file(self.args.target, 'wb')
             else:
-                f = sys.stdout
+                f = instrument(sys.stdout)
             pack.extract_to(self.args.filename, f)
         finally:
-            if f is not sys.stdout:
+            if self.args.target:
                 f.close()
+    def _trace(self):
+        """ Returns the access trace for --layout trace. """
+        if self.args.layout != 'trace':
+            return None
+        return read_trace(self.args.trace_file)
     def cmd_repack(self):
+        if self.args.layout:
+            return self._repack_with_layout()
+        print 'Repacking ...'
+        pack = self._open_pack()
+        self._print_repack_result(pack.repack(self.args.max_bytes))
+        # Moved entries have new keys in the hash cache
+        self._forget_hashes(pack, [])
+    def _repack_with_layout(self):
+        """ Rewrites the datfile with its entries in the order of --layout.
+            The new datfile is written next to the old one and then renamed
+            over it. """
+        if self.args.max_bytes is not None:
+            print 'ERROR --max-bytes cannot be combined with --layout.'
+            return -15
         print 'Repacking ...'
-        pack = FTLPack(self.args.datfile)
-        res = pack.repack()
+        pack = self._open_pack(readonly=True)
+        old_size = os.path.getsize(self.args.datfile)
+        files = layout_files(pack.list_sizes(), self.args.layout,
+                             self._trace())
+        tmp_path = self.args.datfile + '.tmp'
+        with open_file(tmp_path, 'wb') as f:
+            writer = FTLPackWriter(f, files, index_size=len(pack.index))
+            for filename, size in files:
+                writer.add(filename, pack.open_entry(filename), size)
+            writer.close()
+        pack.close()
+        if sys.platform == 'win32':
+            os.unlink(self.args.datfile)
+        os.rename(tmp_path, self.args.datfile)
+        self._drop_hash_cache(self.args.datfile)
+        self._print_repack_result(repack_result(
+                bytes_moved=sum(size for filename, size in files),
+                old_size=old_size, new_size=writer.size,
+                bytes_reclaimed=old_size - writer.size))
+    def _print_repack_result(self, res):
         print
         print ' old size      %s (%s)' % (nice_size(res.old_size),
                                           res.old_size)
@@ -573,8 +2188,10 @@ class Program(object):
         print ' bytes moved   %s (%s; %s%%)' % (
                             nice_size(res.bytes_moved), res.bytes_moved,
                         round(100.0 * res.bytes_moved / res.new_size, 1))
+        print ' reclaimed     %s (%s)' % (nice_size(res.bytes_reclaimed),
+                                          res.bytes_reclaimed)
     def cmd_remove(self):
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack()
         if not self.args.filename in pack:
             if not self.args.force:
                 print ('ERROR %s does not exist.'
@@ -582,8 +2199,9 @@ class Program(object):
                 return -6
         else:
             pack.remove(self.args.filename)
+            self._forget_hashes(pack, [self.args.filename])
     def cmd_replace(self):
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack()
         if not os.path.exists(self.args.replacement):
             print 'ERROR %s does not exist.' % self.args.replacement
             return  -10
@@ -593,28 +2211,345 @@ class Program(object):
                 print ('ERROR %s does not exist. Use -f to add anyway.'
                         % self.args.filename)
                 return -3
+            with open_file(self.args.replacement, 'rb') as f:
+                pack.add(self.args.filename, f, size)
         else:
-            pack.remove(self.args.filename)
-        with open(self.args.replacement, 'rb') as f:
-            pack.add(self.args.filename, f, size)
+            with open_file(self.args.replacement, 'rb') as f:
+                pack.replace(self.args.filename, f, size)
+        self._forget_hashes(pack, [self.args.filename])
     def cmd_unpack(self):
         if self.args.folder is None:
             self.args.folder = self.args.datfile + '-unpacked'
         print 'Loading index ... '
-        pack = FTLPack(self.args.datfile)
+        pack = self._open_pack(readonly=True)
         folder = FolderPack(self.args.folder)
+        # Extract in offset order, such that the datfile is read sequentially
+        filenames = [filename for n, filename, size, offset
+                        in sorted(pack.list_metadata(), key=lambda x: x[3])]
+        if not self.args.force:
+            for filename in filenames:
+                if filename in folder:
+                    print ('ERROR %s already exists. Use -f to override.'
+                                % filename)
+                    return -1
+        folder.create_dirs(filenames)
+        if self.args.store:
+            # The folder is only created by create_dirs if there are files
+            if not os.path.isdir(self.args.folder):
+                os.makedirs(self.args.folder)
+            store = BlobStore(self.args.store)
+            if not store.can_link_into(self.args.folder):
+                # Every file would be written twice: to the store and as a
+                # copy into the folder.
+                print ('WARNING %s cannot be hard linked into %s.  Not '
+                       'using it.' % (self.args.store, self.args.folder))
+                self.args.store = None
+        if self.args.store:
+            cache = None
+            if os.path.exists(self.args.datfile + '.ftlhash'):
+                cache = HashCache(self.args.datfile)
+            print 'Hashing ...'
+            digests = hash_entries(pack, filenames, store.algo,
+                                   self.args.jobs, cache=cache)
+            if cache is not None:
+                cache.save(pack)
+        def extract(filename):
+            path = folder.path(filename)
+            linked = False
+            if self.args.store:
+                digest = digests[filename]
+                store.put(pack, filename, digest)
+                linked = store.link(digest, path)
+            if not linked:
+                with open_file(path, 'wb') as f:
+                    pack.extract_to(filename, f)
+            return filename
         print 'Extracting ...'
-        for filename in pack.list():
-            if filename in folder and not self.args.force:
-                print 'ERROR %s already exists. Use -f to override.' % filename
-                return -1
-            print " %s" % filename
-            pack.extract_to(filename, folder.open(filename, 'wb'))
+        if self.args.jobs > 1:
+            # The entries are read from the memory map, so the workers do
+            # not share a file position.
+            pool = ThreadPool(self.args.jobs)
+            try:
+                for filename in pool.imap(extract, filenames):
+                    print " %s" % filename
+            finally:
+                pool.terminate()
+        else:
+            for filename in filenames:
+                print " %s" % extract(filename)
+    def cmd_batch(self):
+        # Parse and check the whole manifest before changing anything
+        if self.args.manifest == '-':
+            lines = sys.stdin.readlines()
+        else:
+            with open(self.args.manifest) as f:
+                lines = f.readlines()
+        ops = []
+        nargs = {'add': (1, 2), 'replace': (2, 2), 'remove': (1, 1),
+                 'append': (2, 2)}
+        for lineno, line in enumerate(lines, 1):
+            bits = shlex.split(line, comments=True)
+            if not bits:
+                continue
+            if bits[0] not in nargs:
+                print 'ERROR line %s: unknown operation %s' % (lineno, bits[0])
+                return -12
+            if not nargs[bits[0]][0] <= len(bits) - 1 <= nargs[bits[0]][1]:
+                print 'ERROR line %s: wrong number of arguments' % lineno
+                return -12
+            if bits[0] == 'add' and len(bits) == 2:
+                bits.append(ftl_path_join(*ftl_path_split(bits[1])))
+            # Normalize to (operation, filename in datfile, file on disk)
+            if bits[0] in ('add', 'replace'):
+                op = (bits[0], bits[2], bits[1])
+            elif bits[0] == 'append':
+                op = (bits[0], bits[1], bits[2])
+            else:
+                op = (bits[0], bits[1], None)
+            if op[2] is not None and not os.path.exists(op[2]):
+                print 'ERROR line %s: %s does not exist.' % (lineno, op[2])
+                return -12
+            ops.append((lineno, op))
+        print 'Loading index ...'
+        pack = self._open_pack()
+        # Check the operations against the filenames the datfile will have
+        # by then
+        filenames = set(pack.list())
+        for lineno, (op, filename, path) in ops:
+            exists = filename in filenames
+            if op == 'remove':
+                if not exists and not self.args.force:
+                    print ('ERROR line %s: %s does not exist.'
+                                % (lineno, filename))
+                    return -12
+                filenames.discard(filename)
+                continue
+            if exists == (op == 'add') and not self.args.force:
+                print ('ERROR line %s: %s %s.' % (lineno, filename,
+                            'already exists' if exists
+                                    else 'does not exist'))
+                return -12
+            filenames.add(filename)
+        # Apply it against a single index
+        touched = []
+        print 'Applying %s operations ...' % len(ops)
+        with pack.batch():
+            for lineno, (op, filename, path) in ops:
+                print ' %s %s' % (op, filename)
+                exists = filename in pack
+                if op == 'remove':
+                    if exists:
+                        pack.remove(filename)
+                    touched.append(filename)
+                    continue
+                size = os.stat(path).st_size
+                with open_file(path, 'rb') as f:
+                    if not exists:
+                        pack.add(filename, f, size)
+                    elif op == 'append':
+                        pack.append(filename, f, size)
+                    else:
+                        pack.replace(filename, f, size)
+                touched.append(filename)
+        self._forget_hashes(pack, touched)
+    def cmd_sync(self):
+        if self.args.folder is None:
+            self.args.folder = self.args.datfile + '-unpacked'
+        print 'Loading index ...'
+        pack = self._open_pack()
+        folder = FolderPack(self.args.folder)
+        print 'Comparing ...'
+        files = dict(folder.list_sizes())
+        removed = sorted(filename for filename in pack.list()
+                            if filename not in files)
+        added = sorted(filename for filename in files
+                            if filename not in pack)
+        # Files with a different size have changed for sure.  The others
+        # are compared by hash.  Modification times cannot tell: the
+        # datfile might have been changed after a file was edited.  The
+        # hashes of the datfile are cached, so only the folder is read
+        # each time.
+        changed = []
+        candidates = []
+        for filename, size in sorted(files.iteritems()):
+            if filename not in pack:
+                continue
+            if pack.entry(filename).size != size:
+                changed.append(filename)
+            else:
+                candidates.append(filename)
+        if self.hash_cache is None:
+            self.hash_cache = HashCache(self.args.datfile)
+        if candidates:
+            hashes = hash_entries(pack, candidates, cache=self.hash_cache)
+            for filename in candidates:
+                hf = HashFile()
+                with folder.open(filename) as f:
+                    copy_data(f, hf, files[filename])
+                if hf.finish_up() != hashes[filename]:
+                    changed.append(filename)
+            changed.sort()
+        # Apply the changes
+        for filename in removed:
+            print " - %s" % filename
+            if not self.args.dry_run:
+                pack.remove(filename)
+        for filename in changed:
+            print " ~ %s" % filename
+            if not self.args.dry_run:
+                with folder.open(filename) as f:
+                    pack.replace(filename, f, files[filename])
+        for filename in added:
+            print " + %s" % filename
+            if not self.args.dry_run:
+                with folder.open(filename) as f:
+                    pack.add(filename, f, files[filename])
+        if not self.args.dry_run:
+            self._forget_hashes(pack, removed + changed + added)
+        elif self.hash_cache is not None:
+            self.hash_cache.save(pack)
+        print
+        print '  %s removed, %s changed, %s added' % (len(removed),
+                                    len(changed), len(added))
+        if self.args.repack and not self.args.dry_run:
+            print
+            print 'Repacking ...'
+            self._print_repack_result(pack.repack())
+            self._forget_hashes(pack, [])
+    def cmd_index(self):
+        print 'Loading index ...'
+        pack = self._open_pack(readonly=True)
+        print 'Writing %s ...' % pack.index_cache
+        pack.save_index_cache()
+    def cmd_diff(self):
+        packs = []
+        caches = []
+        for datfile in (self.args.datfile, self.args.other):
+            packs.append(self._open_pack(readonly=True, datfile=datfile))
+            caches.append(HashCache(datfile)
+                    if os.path.exists(datfile + '.ftlhash') else None)
+        added, removed, changed = diff_packs(packs[0], packs[1],
+                                             self.args.jobs, *caches)
+        if self.args.json:
+            json.dump({'added': added, 'removed': removed,
+                       'changed': changed}, sys.stdout, indent=2,
+                      sort_keys=True)
+            print
+        else:
+            lines = [('A', filename) for filename in added]
+            lines.extend(('D', filename) for filename in removed)
+            lines.extend(('M', filename) for filename in changed)
+            for status, filename in sorted(lines, key=lambda x: x[1]):
+                print '%s %s' % (status, filename)
+        return 1 if added or removed or changed else 0
+    def cmd_merge(self):
+        to_stdout = self.args.datfile == '-'
+        # Keep stdout clean if we write the datfile to it
+        log = sys.stderr if to_stdout else sys.stdout
+        if (not to_stdout and os.path.exists(self.args.datfile)
+                and not self.args.force):
+            print ('ERROR %s already exists. Use -f to override.'
+                    % self.args.datfile)
+            return -16
+        print >> log, 'Loading indices ...'
+        # { filename: (pack, size) } in the order of the first pack that
+        # has the file; later packs override earlier ones.
+        entries = collections.OrderedDict()
+        for datfile in self.args.sources:
+            pack = self._open_pack(readonly=True, datfile=datfile)
+            for n, entry in pack.iter_entries():
+                entries[entry.filename] = (pack, entry.size)
+        files = [(filename, size) for filename, (pack, size)
+                    in entries.iteritems()]
+        if self.args.layout:
+            files = layout_files(files, self.args.layout, self._trace())
+        index_size = max(self.args.indexsize or 0, len(files))
+        print >> log, 'Merging ...'
+        if to_stdout:
+            if sys.platform == 'win32':
+                import msvcrt
+                msvcrt.setmode(sys.stdout.fileno(), os.O_BINARY)
+            f = instrument(sys.stdout)
+        else:
+            # The output might be one of the sources
+            tmp_path = self.args.datfile + '.tmp'
+            f = open_file(tmp_path, 'wb')
+        try:
+            writer = FTLPackWriter(f, files, index_size=index_size)
+            for filename, size in files:
+                pack = entries[filename][0]
+                writer.add_buffer(filename, pack.view(filename))
+            writer.close()
+        finally:
+            if not to_stdout:
+                f.close()
+        if not to_stdout:
+            for pack in self.packs:
+                pack.close()
+            if sys.platform == 'win32' and os.path.exists(self.args.datfile):
+                os.unlink(self.args.datfile)
+            os.rename(tmp_path, self.args.datfile)
+            self._drop_hash_cache(self.args.datfile)
+        print >> log, 'Merged %s files from %s datfiles' % (
+                            len(files), len(self.args.sources))
+    def cmd_serve(self):
+        server = PackServer((self.args.bind, self.args.port),
+                            self.args.datfile)
+        print 'Serving %s on http://%s:%s/ ...' % (self.args.datfile,
+                                                   self.args.bind,
+                                                   self.args.port)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    def _report_stats(self):
+        """ Prints the I/O statistics to stderr and writes them as JSON if
+            requested. """
+        summary = io_stats.summary()
+        if self.args.stats_json:
+            with open(self.args.stats_json, 'w') as f:
+                json.dump(summary, f, indent=2)
+        if self.args.record_trace:
+            with open(self.args.record_trace, 'w') as f:
+                for filename in io_stats.accessed:
+                    f.write('%s\n' % filename)
+        if not self.args.stats:
+            return
+        print >> sys.stderr
+        print >> sys.stderr, '%-12s %9s %7s %7s %9s %7s %9s %9s' % (
+                'phase', 'time', 'seeks', 'reads', 'read', 'writes',
+                'written', 'mapped')
+        for phase in summary['phases']:
+            print >> sys.stderr, '%-12s %8.3fs %7s %7s %9s %7s %9s %9s' % (
+                    phase['phase'], phase['time'], phase['seeks'],
+                    phase['reads'], nice_size(phase['bytes_read']),
+                    phase['writes'], nice_size(phase['bytes_written']),
+                    nice_size(phase['bytes_mapped']))
+        print >> sys.stderr, '%-12s %8.3fs' % ('total', summary['wall_time'])
     def main(self):
+        global io_stats
         self.parse_args()
-        return self.args.func()
+        if self.args.stats or self.args.stats_json or self.args.record_trace:
+            io_stats = IOStats()
+        try:
+            return self.args.func()
+        finally:
+            for pack in self.packs:
+                pack.close()
+            if io_stats is not None:
+                self._report_stats()
     def parse_args(self):
         parser = argparse.ArgumentParser()
+        parser.add_argument('--stats', action='store_true',
+                help='Print I/O statistics per phase to stderr afterwards')
+        parser.add_argument('--stats-json', default=None, metavar='FILE',
+                help='Write I/O statistics as JSON to FILE')
+        parser.add_argument('--record-trace', default=None, metavar='FILE',
+                help='Write the files whose contents are read, in order, '+
+                     'to FILE.  Use as --trace-file for --layout trace')
         subparsers = parser.add_subparsers(title='commands',
                                         description='Valid commands')
         parser_info = subparsers.add_parser('info',
@@ -622,21 +2557,23 @@ class Program(object):
         parser_info.add_argument('datfile',
                 help='The datfile to examine')
         parser_info.add_argument('--hashes', '-H', action='store_true',
-                help='Show MD5 hashes')
+                help='Show hashes')
         parser_info.add_argument('--bytes', '-B', action='store_true',
                 help='Show sizes in bytes')
+        self._add_hash_arguments(parser_info)
         parser_info.set_defaults(func=self.cmd_info)
 
         parser_pack = subparsers.add_parser('pack',
                 help='Creates a datfile from a folder')
         parser_pack.add_argument('datfile',
-                help="The datfile to create")
+                help="The datfile to create.  Use - for stdout")
         parser_pack.add_argument('folder', nargs='?', default=None,
                 help="The folder to pack. Defaults to [datfile]-unpacked")
         parser_pack.add_argument('--indexsize', '-I', default=None, type=int,
                 help="Index size.")
         parser_pack.add_argument('-f', '--force', action='store_true',
                 help='Override existing datfile')
+        self._add_layout_arguments(parser_pack)
         parser_pack.set_defaults(func=self.cmd_pack)
 
         parser_unpack = subparsers.add_parser('unpack',
@@ -647,6 +2584,16 @@ class Program(object):
                 help="The folder to extract to. Defaults to [datfile]-unpacked")
         parser_unpack.add_argument('-f', '--force', action='store_true',
                 help='Override existing files')
+        parser_unpack.add_argument('-j', '--jobs', default=1, type=int,
+                help='Number of files to extract in parallel')
+        parser_unpack.add_argument('--store', '-s', default=None,
+                metavar='DIR',
+                help='Keep the contents of the files once in the '+
+                     'content-addressed store DIR and hard link them '+
+                     'into the folder.  DIR is not used if it is on '+
+                     'another filesystem than the folder.  Do not edit '+
+                     'linked files in place: that changes them in the '+
+                     'store too')
         parser_unpack.set_defaults(func=self.cmd_unpack)
 
         parser_add = subparsers.add_parser('add',
@@ -709,18 +2656,103 @@ class Program(object):
         parser_extract.set_defaults(func=self.cmd_extract)
 
         parser_hashes = subparsers.add_parser('hashes',
-                help='Shows the filenames and their md5 hashes alphabetically.'+
+                help='Shows the filenames and their hashes alphabetically.'+
                      '  Useful for debugging.')
         parser_hashes.add_argument('datfile',
                 help='The datfile to examine')
+        self._add_hash_arguments(parser_hashes)
         parser_hashes.set_defaults(func=self.cmd_hashes)
 
         parser_repack = subparsers.add_parser('repack',
                 help='Repacks the datfile: removes overhead')
         parser_repack.add_argument('datfile',
                 help='The datfile to repack')
+        parser_repack.add_argument('--max-bytes', '-m', default=None,
+                type=int,
+                help='Move at most this many bytes.  The entries that '+
+                     'reclaim the most space are moved first')
+        self._add_layout_arguments(parser_repack)
         parser_repack.set_defaults(func=self.cmd_repack)
 
+        parser_batch = subparsers.add_parser('batch',
+                help='Applies a list of operations to a datfile at once')
+        parser_batch.add_argument('datfile',
+                help='The datfile to change')
+        parser_batch.add_argument('manifest', nargs='?', default='-',
+                help='File with one operation per line: "add file '+
+                     '[filename]", "replace replacement filename", '+
+                     '"remove filename" or "append filename appendix".  '+
+                     'Defaults to stdin')
+        parser_batch.add_argument('-f', '--force', action='store_true',
+                help='Add missing files on replace and append, replace '+
+                     'existing files on add and ignore missing files on '+
+                     'remove')
+        parser_batch.set_defaults(func=self.cmd_batch)
+
+        parser_sync = subparsers.add_parser('sync',
+                help='Updates a datfile with the changes in a folder')
+        parser_sync.add_argument('datfile',
+                help='The datfile to update')
+        parser_sync.add_argument('folder', nargs='?', default=None,
+                help="The folder to sync from. Defaults to [datfile]-unpacked")
+        parser_sync.add_argument('--checksum', '-c', action='store_true',
+                help='Does nothing: files of equal size are always '+
+                     'compared by hash.  The hashes of the datfile are '+
+                     'cached in [datfile].ftlhash')
+        parser_sync.add_argument('--repack', '-r', action='store_true',
+                help='Repack the datfile afterwards')
+        parser_sync.add_argument('--dry-run', '-n', action='store_true',
+                help='Only show what would change')
+        parser_sync.set_defaults(func=self.cmd_sync)
+
+        parser_index = subparsers.add_parser('index',
+                help='Caches the index of a datfile in [datfile].ftlidx.  '+
+                     'Once it exists, it is used and kept up to date')
+        parser_index.add_argument('datfile',
+                help='The datfile to index')
+        parser_index.set_defaults(func=self.cmd_index)
+
+        parser_diff = subparsers.add_parser('diff',
+                help='Shows which files were added (A), removed (D) or '+
+                     'changed (M) between two datfiles.  Exits with 1 if '+
+                     'they differ')
+        parser_diff.add_argument('datfile',
+                help='The old datfile')
+        parser_diff.add_argument('other',
+                help='The new datfile')
+        parser_diff.add_argument('--json', action='store_true',
+                help='Output the lists of added, removed and changed '+
+                     'files as JSON')
+        parser_diff.add_argument('-j', '--jobs', default=1, type=int,
+                help='Number of files to compare in parallel')
+        parser_diff.set_defaults(func=self.cmd_diff)
+
+        parser_merge = subparsers.add_parser('merge',
+                help='Creates a datfile with the files of several datfiles.  '+
+                     'Files in later datfiles override those in earlier ones')
+        parser_merge.add_argument('datfile',
+                help="The datfile to create.  Use - for stdout")
+        parser_merge.add_argument('sources', nargs='+',
+                help='The datfiles to merge, for instance the original '+
+                     'datfile followed by mods')
+        parser_merge.add_argument('--indexsize', '-I', default=None,
+                type=int,
+                help="Index size.")
+        parser_merge.add_argument('-f', '--force', action='store_true',
+                help='Override existing datfile')
+        self._add_layout_arguments(parser_merge)
+        parser_merge.set_defaults(func=self.cmd_merge)
+
+        parser_serve = subparsers.add_parser('serve',
+                help='Serves the files in a datfile over HTTP')
+        parser_serve.add_argument('datfile',
+                help='The datfile to serve')
+        parser_serve.add_argument('--port', '-p', default=8000, type=int,
+                help='The port to listen on.  Defaults to 8000')
+        parser_serve.add_argument('--bind', '-b', default='127.0.0.1',
+                help='The address to listen on.  Defaults to 127.0.0.1')
+        parser_serve.set_defaults(func=self.cmd_serve)
+
         parser_list = subparsers.add_parser('list',
                 help='Lists the filenames in the datfile')
         parser_list.add_argument('datfile',
@@ -728,9 +2760,40 @@ class Program(object):
         parser_list.set_defaults(func=self.cmd_list)
 
         self.args = parser.parse_args()
+        if (getattr(self.args, 'layout', None) == 'trace' and
+                not self.args.trace_file):
+            parser.error('--layout trace requires --trace-file')
+    def _add_layout_arguments(self, parser):
+        parser.add_argument('--layout', '-L', default=None, choices=LAYOUTS,
+                help='Order the files by folder (dir), by size, smallest '+
+                     'first (size) or by --trace-file (trace), such that '+
+                     'files read together are stored together')
+        parser.add_argument('--trace-file', '-T', default=None,
+                metavar='FILE',
+                help='File with the filenames in the order they are read, '+
+                     'one per line.  See --record-trace')
+    def _add_hash_arguments(self, parser):
+        parser.add_argument('--algo', '-a', default='md5',
+                choices=HASH_ALGORITHMS,
+                help='The hash algorithm to use.  Defaults to md5')
+        parser.add_argument('-j', '--jobs', default=1, type=int,
+                help='Number of files to hash in parallel')
+        parser.add_argument('--processes', action='store_true',
+                help='Hash in parallel with processes instead of threads')
+        parser.add_argument('--cache', '-c', action='store_true',
+                help='Cache the hashes in [datfile].ftlhash.  An existing '+
+                     'cache is always used')
+        parser.add_argument('--no-cache', action='store_true',
+                help='Ignore [datfile].ftlhash')
 
 def main():
-    return Program().main()
+    try:
+        return Program().main()
+    except IOError as e:
+        # Stop quietly if the output is piped into, say, head
+        if e.errno != errno.EPIPE:
+            raise
+        return -13
 
 if __name__ == '__main__':
     sys.exit(main())
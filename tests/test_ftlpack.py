@@ -0,0 +1,179 @@
+import StringIO
+import tempfile
+import unittest
+import random
+import shutil
+import sys
+import os
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import main
+
+class FreeExtentsTest(unittest.TestCase):
+    def test_release_merges_adjacent_holes(self):
+        free = main.FreeExtents()
+        free.release(10, 5)
+        free.release(20, 5)
+        free.release(15, 5)
+        self.assertEqual(free.starts, {10: 15})
+        self.assertEqual(free.ending_at(25), 10)
+    def test_allocate_takes_best_fit(self):
+        free = main.FreeExtents()
+        free.release(0, 100)
+        free.release(200, 10)
+        self.assertEqual(free.allocate(8), 200)
+        self.assertEqual(free.size_at(208), 2)
+        self.assertEqual(free.allocate(50), 0)
+        self.assertEqual(free.size_at(50), 50)
+        self.assertEqual(free.allocate(51), None)
+    def test_reserve_splits_holes(self):
+        free = main.FreeExtents()
+        free.release(0, 100)
+        free.reserve(40, 20)
+        self.assertEqual(free.starts, {0: 40, 60: 40})
+        self.assertEqual(free.total(), 80)
+
+class FTLPackTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.dat')
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+    def add(self, pack, filename, data):
+        pack.add(filename, StringIO.StringIO(data), len(data))
+    def contents(self):
+        pack = main.FTLPack(self.path, readonly=True)
+        try:
+            return dict((filename, pack.view(filename)[:])
+                            for filename in pack.list())
+        finally:
+            pack.close()
+    def test_grow_index_past_end_of_file(self):
+        pack = main.FTLPack(self.path, create=True, index_size=4,
+                            index_headroom=4)
+        for i in xrange(5):
+            self.add(pack, 'f%s' % i, chr(ord('a') + i))
+        pack.close()
+        self.assertEqual(self.contents(), dict(('f%s' % i, chr(ord('a') + i))
+                                                for i in xrange(5)))
+    def test_grow_index_by_a_lot(self):
+        pack = main.FTLPack(self.path, create=True, index_size=2)
+        self.add(pack, 'a', 'first')
+        self.add(pack, 'b', 'second')
+        pack._grow_index(1000)
+        self.add(pack, 'c', 'third')
+        pack.close()
+        self.assertEqual(self.contents(),
+                         {'a': 'first', 'b': 'second', 'c': 'third'})
+    def test_repack_within_budget_skips_expensive_holes(self):
+        pack = main.FTLPack(self.path, create=True, index_size=5)
+        self.add(pack, 'hole1', 'x' * 10)
+        self.add(pack, 'big', 'b' * 100000)
+        self.add(pack, 'hole2', 'y' * 10)
+        self.add(pack, 'tail1', 'c' * 50)
+        self.add(pack, 'tail2', 'd' * 50)
+        pack.remove('hole1')
+        pack.remove('hole2')
+        old_size = pack.eof
+        res = pack.repack(10000)
+        self.assertTrue(0 < res.bytes_moved <= 10000)
+        self.assertEqual(res.bytes_reclaimed, 8 + 5 + 10)
+        self.assertEqual(pack.eof, old_size - res.bytes_reclaimed)
+        # Only the hole before the big entry is left, which is too
+        # expensive to close
+        self.assertEqual(len(pack.free), 1)
+        self.assertEqual(pack.repack(10000).bytes_moved, 0)
+        pack.close()
+        self.assertEqual(self.contents(), {'big': 'b' * 100000,
+                                           'tail1': 'c' * 50,
+                                           'tail2': 'd' * 50})
+    def test_repeated_repack_within_budget_converges(self):
+        pack = main.FTLPack(self.path, create=True, index_size=50)
+        expected = {}
+        for i in xrange(50):
+            expected['f%s' % i] = chr(ord('a') + i % 26) * (i * 37 % 500)
+            self.add(pack, 'f%s' % i, expected['f%s' % i])
+        for i in xrange(0, 50, 3):
+            pack.remove('f%s' % i)
+            del expected['f%s' % i]
+        while pack.repack(1000).bytes_moved:
+            pass
+        self.assertEqual(len(pack.free), 0)
+        pack.close()
+        self.assertEqual(self.contents(), expected)
+    def test_hash_entries_in_threads_without_map(self):
+        pack = main.FTLPack(self.path, create=True, index_size=200)
+        for i in xrange(200):
+            self.add(pack, 'f%s' % i, os.urandom(i * 50))
+        expected = dict((filename, main.hashlib.md5(
+                                pack.open_entry(filename).read()).hexdigest())
+                            for filename in pack.list())
+        self.assertEqual(pack.map, None)
+        self.assertEqual(main.hash_entries(pack, pack.list(), jobs=8),
+                         expected)
+        pack.close()
+    def random_change(self, pack, rnd, expected):
+        r = rnd.random()
+        if r < 0.4 or not expected:
+            filename = 'f%s' % rnd.randint(0, 40)
+            data = os.urandom(rnd.randint(0, 30))
+            if filename in expected:
+                pack.replace(filename, StringIO.StringIO(data), len(data))
+            else:
+                self.add(pack, filename, data)
+            expected[filename] = data
+        elif r < 0.6:
+            filename = rnd.choice(sorted(expected))
+            data = os.urandom(rnd.randint(0, 30))
+            pack.append(filename, StringIO.StringIO(data), len(data))
+            expected[filename] += data
+        elif r < 0.85:
+            filename = rnd.choice(sorted(expected))
+            pack.remove(filename)
+            del expected[filename]
+        elif len(pack.index) < 1000:
+            pack._grow_index(rnd.randint(1, 100))
+    def reopen(self, pack, expected):
+        """ Closes <pack>, checks what is on disk, also through the index
+            cache, and opens it again. """
+        pack.close()
+        self.assertEqual(self.contents(), expected)
+        cached = main.FTLPack(self.path, readonly=True,
+                              index_cache=self.path + '.ftlidx')
+        plain = main.FTLPack(self.path, readonly=True)
+        self.assertEqual(cached.metadata, plain.metadata)
+        self.assertEqual(cached.index, plain.index)
+        cached.close()
+        plain.close()
+        return main.FTLPack(self.path, index_cache=self.path + '.ftlidx')
+    def test_random_changes(self):
+        for seed in xrange(20):
+            rnd = random.Random(seed)
+            pack = main.FTLPack(self.path, create=True,
+                                index_size=rnd.randint(1, 4),
+                                index_headroom=rnd.choice([0, 0.5, 4]),
+                                index_cache=self.path + '.ftlidx')
+            expected = {}
+            for step in xrange(100):
+                r = rnd.random()
+                if r < 0.05:
+                    pack = self.reopen(pack, expected)
+                elif r < 0.07:
+                    pack.save_index_cache()
+                elif r < 0.15:
+                    # Slot writes and releases are deferred to the end
+                    with pack.batch():
+                        for i in xrange(rnd.randint(1, 10)):
+                            self.random_change(pack, rnd, expected)
+                else:
+                    self.random_change(pack, rnd, expected)
+            pack = self.reopen(pack, expected)
+            pack.close()
+            os.unlink(self.path)
+            if os.path.exists(self.path + '.ftlidx'):
+                os.unlink(self.path + '.ftlidx')
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim: et:sw=4:ts=4:bs=2